@@ -1,5 +1,6 @@
+import sys
 from .src import main
 
 
 if __name__ == "__main__":
-    main.main()
+    sys.exit(main.main())
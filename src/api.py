@@ -0,0 +1,179 @@
+"""
+This script provides a Python API that streams the MD&A section of HKEX reports. Reports are downloaded into memory and
+read with fitz, so nothing is written to disk unless save_path is given. The run configuration, metadata.db and the
+log file are not used.
+Usage:
+    api = importlib.import_module('hkex-text-mda.src.api')
+    for record in api.iter_mda(['00001'], '2022', '2022', report_type='40100'):
+        print(record['file_name'], record['page_start'], record['page_end'], record['eng_text'][:100])
+"""
+import os
+import sys
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .utils import logger
+from . import utils, get_report, get_mda, extract_text
+
+T1CODE = 40000  ## => Financial Statements/ESG Information, as in the CLI
+
+
+def iter_mda(stock_codes, from_date, to_date, report_type='40100', save_path=None, concurrency=2, rate_limit=2.0,
+             title_cache_size=10000, base_url=None, layout=False):
+    """
+    Streams one record per report in listing order. At most `concurrency` reports are held in memory: the next ones
+    are downloaded while the current one is parsed, and each is released once its record is yielded.
+    :param stock_codes: list of stock codes such as ['00001', '00700'], or None for all stocks
+    :param from_date: yyyymmdd, yyyymm or yyyy, like --from_date
+    :param to_date: same format as from_date
+    :param report_type: tier two code, like --report_type ('40100' annual, '40200' semi-annual, '40300' quarterly)
+    :param save_path: If given, each report and its MD&A text files are also saved there, in the CLI's folder layout.
+    :param concurrency: number of reports downloaded ahead of the one being parsed
+    :param rate_limit: maximum HKEX requests per second. 0 or None disables the limit.
+    :param title_cache_size: number of outline title scores kept in memory
+    :param base_url: HKEXnews host, like --base_url. The one set last is used if None.
+    :param layout: drops running headers and footers by their position on the page, like --layout
+    :return: generator of dicts holding the report metadata (stock_code, stock_name, news_id, date_time, title,
+    file_link, file_name), the MD&A match (mda_title, page_start, page_end, status) and its eng_text and chi_text.
+    status is one of success, fail, no_pageNum, none or error, like metadata_mda, and the texts are empty unless it is
+    success. get_report.SearchError is raised if a search page fails all its retries, after the records listed before
+    it, since the rest of the listing would be missing.
+    """
+    get_report.init_session(concurrency, rate_limit)
+    if base_url is not None:
+        get_report.set_base_url(base_url)
+    cache = get_mda.TitleScoreCache(db_path=':memory:', max_size=title_cache_size)
+    stock_ids = [-1]
+    if stock_codes:
+        stock_ids = utils.resolve_stockIds(stock_codes, concurrency=max(concurrency, 1), rate_limit=rate_limit,
+                                           base_url=get_report.BASE_URL)
+    prior_titles = {}
+
+    executor = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+    pending = deque()
+    try:
+        for row, month_folder in list_reports(stock_ids, from_date, to_date, report_type):
+            pending.append((row, month_folder, executor.submit(fetch_report, row, cache)))
+            if len(pending) >= max(concurrency, 1):
+                yield read_report(*pending.popleft(), prior_titles, cache, save_path, layout)
+        while pending:
+            yield read_report(*pending.popleft(), prior_titles, cache, save_path, layout)
+    finally:
+        """Downloads not started yet are dropped if the caller stops iterating early"""
+        executor.shutdown(cancel_futures=True)
+
+
+def list_reports(stock_ids, from_date, to_date, report_type):
+    """
+    :return: generator of (filing, month_folder) for every search window and stock. month_folder is the filing's
+    'yyyy_mm', or None for a yyyymmdd range, like the CLI folders.
+    """
+    for fromDateVal, toDateVal in get_report.search_windows(from_date, to_date):
+        for stockId in stock_ids:
+            for rptList in get_report.search_pages(fromDateVal, toDateVal, stockId, T1CODE, report_type):
+                for row in rptList:
+                    yield row, get_report.report_month(row) if len(from_date) != 8 else None
+
+
+def fetch_report(row, cache):
+    """
+    Downloads a filing into memory. Runs in a download thread. For HTML annual reports, the MD&A section PDF linked
+    from the index page is downloaded instead, the same way get_report.get_pdf does.
+    :return: (content, section_title). section_title is the matched link text for an MD&A section PDF, else None.
+    """
+    filename, filetype = get_report.report_filename(row)
+    url = get_report.BASE_URL + row['FILE_LINK']
+    content = get_report.http_get(url).content
+    if (filetype in ['htm', 'txt']) and ('annual' in filename.lower()):
+        mda_link = get_report.find_mda_link(content, url, cache)
+        if mda_link is None:
+            return None, None
+        return get_report.http_get(mda_link[1]).content, mda_link[0]
+    if filetype != 'pdf':
+        return None, None
+    return content, None
+
+
+def read_report(row, month_folder, future, prior_titles, cache, save_path, layout=False):
+    """
+    Finds the MD&A pages of a downloaded report and extracts their text, like extract_mda and extract_mda_text.
+    :return: record as described in iter_mda
+    """
+    import fitz
+    filename = get_report.report_filename(row)[0]
+    ticker = filename.split("_")[0]
+    record = {'stock_code': row['STOCK_CODE'], 'stock_name': row['STOCK_NAME'], 'news_id': row['NEWS_ID'],
+              'date_time': row['DATE_TIME'], 'title': row['TITLE'], 'file_link': row['FILE_LINK'],
+              'file_name': filename, 'mda_title': None, 'page_start': None, 'page_end': None, 'status': 'none',
+              'eng_text': '', 'chi_text': ''}
+    try:
+        content, section_title = future.result()
+        if content is None:
+            return record
+        doc = fitz.open(stream=content, filetype='pdf')
+        try:
+            if section_title is not None:
+                """The linked PDF is the MD&A section itself"""
+                mda_match, start_page, end_page = section_title, 1, doc.page_count
+            else:
+                doc_outline = [element for element in doc.get_toc() if element[0] == 1]
+                if len(doc_outline) == 0:
+                    logger.info(f"{filename} : None : [No outline]")
+                    return record
+                prior_title = prior_titles.get(ticker)
+                mda_match = get_mda.find_prior_title(doc_outline, prior_title) if prior_title else None
+                if mda_match is not None:
+                    start_page, end_page = get_mda.find_section_range(mda_match, doc_outline)
+                else:
+                    mda_match, start_page, end_page = get_mda.find_mda_range(doc_outline, cache=cache)
+            if isinstance(mda_match, list):
+                record['status'] = 'fail'
+                logger.info(f"{filename} : None : [Fail]")
+                return record
+            record['mda_title'] = mda_match
+            if start_page == -1 or end_page == -1:
+                record['status'] = 'no_pageNum'
+                logger.info(f"{filename} : None : [pageNum does not exist]")
+                return record
+            if start_page < 1 or end_page > doc.page_count:
+                raise IndexError(f"Page range {start_page}-{end_page} is out of bounds for {doc.page_count} pages")
+            """Copying the pages first keeps the text identical to what extract_text reads from the MD&A PDF"""
+            mda_doc = fitz.open()
+            mda_doc.insert_pdf(doc, from_page=start_page - 1, to_page=end_page - 1)
+            eng_text_list, chi_text_list = extract_text.extract_doc_text(mda_doc, layout=layout)
+            mda_doc.close()
+        finally:
+            doc.close()
+        record.update(page_start=start_page, page_end=end_page, status='success',
+                      eng_text=extract_text.clean_text(eng_text_list, language='eng', remove_repeated=not layout),
+                      chi_text=extract_text.clean_text(chi_text_list, language='chi', remove_repeated=not layout))
+        if section_title is None:
+            prior_titles[ticker] = mda_match
+        logger.info(f"{filename} : {mda_match} : [Success]")
+        if save_path:
+            save_record(save_path, month_folder, content if section_title is None else None, record)
+    except Exception:
+        logger.debug(traceback.print_exception(*sys.exc_info()))
+        record['status'] = 'error'
+    return record
+
+
+def save_record(save_path, month_folder, content, record):
+    """
+    Writes a report and its MD&A text files under save_path, named like the CLI stages name them.
+    :param content: report PDF, or None to write the text files only
+    """
+    folder = month_folder or ''
+    reports_path = os.path.join(save_path, 'hkex_reports', folder)
+    text_path = os.path.join(save_path, 'hkex_reports_mda_text', folder)
+    os.makedirs(text_path, exist_ok=True)
+    if content is not None:
+        os.makedirs(reports_path, exist_ok=True)
+        with open(os.path.join(reports_path, record['file_name']), 'wb') as f:
+            f.write(content)
+    mda_fname = os.path.basename(get_mda.mda_fpath(record['file_name'], record['mda_title'], record['page_start'],
+                                                   record['page_end'], text_path))
+    for language, text in [('ENG', record['eng_text']), ('CHI', record['chi_text'])]:
+        if len(text) > 0:
+            with open(os.path.join(text_path, mda_fname.replace(".pdf", f"_{language}.txt")), 'w') as f:
+                f.write(text)
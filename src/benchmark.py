@@ -0,0 +1,331 @@
+"""
+This script benchmarks the package import time against a budget, then MD&A page-range extraction on the sample
+reports in reports_data. The latter compares the PyPDF2 round-trip (pdf_extract_range) with the single-open fitz path
+(pdf_extract_range_fitz). Then each extraction hot path is timed over the sample reports and MD&A PDFs, in docs/sec
+and pages/sec, and the peak memory of text extraction measured with and without --stream. Results can be saved as
+JSON and compared against an earlier run, to flag regressions.
+Usage: python -m hkex-text-mda.src.benchmark [--samples_path PATH] [--repeat N] [--import_budget MS]
+                                             [--json PATH] [--compare BASELINE_PATH] [--tolerance SHARE]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+module_path = os.path.dirname(os.path.abspath(__file__))
+default_samples_path = os.path.join(os.path.dirname(module_path), 'reports_data')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks MD&A page-range extraction on the bundled samples.")
+    parser.add_argument("--samples_path", "-s", required=False, default=default_samples_path,
+                        help="Directory holding an 'hkex_reports' folder of sample reports. Default: ./reports_data")
+    parser.add_argument("--repeat", "-r", required=False, type=int, default=3,
+                        help="Number of timed runs per report and engine. The fastest run is reported. Default: 3")
+    parser.add_argument("--import_budget", "-ib", required=False, type=float, default=150.0,
+                        help="Maximum milliseconds that importing the package's main module may add to a bare "
+                             "interpreter start. The benchmark exits with status 1 if it is exceeded. Default: 150")
+    parser.add_argument("--min_time", "-mt", required=False, type=float, default=1.0,
+                        help="Seconds for which each hot path step is rerun, beyond --repeat runs, before its fastest "
+                             "run is reported. Default: 1")
+    parser.add_argument("--json", "-j", required=False,
+                        help="Saves the results to this JSON file, e.g. to serve as a later --compare baseline.")
+    parser.add_argument("--compare", "-c", required=False,
+                        help="JSON file saved by an earlier --json run. Steps more than --tolerance slower per page "
+                             "are flagged, and the benchmark exits with status 1.")
+    parser.add_argument("--tolerance", "-t", required=False, type=float, default=0.2,
+                        help="Share by which a step may be slower per page than in the baseline. Default: 0.2")
+    return parser.parse_args()
+
+
+def list_reports(samples_path, folder='hkex_reports'):
+    reports_root = os.path.join(samples_path, folder)
+    pdf_list = []
+    for root, dirs, files in os.walk(reports_root):
+        pdf_list += [os.path.join(root, file) for file in sorted(files) if file.lower().endswith('pdf')]
+    return sorted(pdf_list)
+
+
+def best_of(repeat, func):
+    """Like timeit, garbage collection is paused during the timed runs, so that its pauses do not add noise"""
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start_time)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return min(timings)
+
+
+def autorange(repeat, min_time, func):
+    """
+    Like best_of, but with as many more runs as fit in min_time seconds, since the minimum of a few runs of a step
+    taking milliseconds still varies by a third on a busy machine.
+    """
+    first = best_of(1, func)
+    runs = max(repeat, int(min_time / max(first, 1e-6))) - 1
+    return min(first, best_of(runs, func)) if runs > 0 else first
+
+
+def bench_import(repeat, budget_ms):
+    """
+    Times a fresh interpreter importing the package's main module, minus a bare interpreter start, in milliseconds.
+    Importing must not parse arguments, open databases or load the PDF and HTTP libraries, so this stays small.
+    :return: import time in milliseconds
+    """
+    package_name = __package__.rsplit('.', 1)[0]
+    package_parent = os.path.dirname(os.path.dirname(module_path))
+
+    def interpreter_ms(code):
+        return best_of(repeat, lambda: subprocess.run([sys.executable, '-c', code], cwd=package_parent,
+                                                      check=True, capture_output=True)) * 1000
+
+    bare_ms = interpreter_ms('pass')
+    import_ms = interpreter_ms(f"import importlib; importlib.import_module('{package_name}.src.main')") - bare_ms
+    print(f"import {package_name}.src.main: {import_ms:.1f}ms over a bare interpreter ({bare_ms:.1f}ms), "
+          f"budget {budget_ms:.0f}ms: {'ok' if import_ms <= budget_ms else 'OVER BUDGET'}")
+    return import_ms
+
+
+def bench_extract_range(pdf_list, repeat, tmp_path):
+    """
+    Times both extraction paths on each report's MD&A range, or on its first 12 pages if no MD&A is matched. The fitz
+    timing includes fitz.open and get_toc, since get_mda already pays for those; the PyPDF2 timing is on top of that.
+    :return: dict of step results per engine, as in bench_hot_paths
+    """
+    import fitz
+    from . import get_mda
+
+    engines = {
+        'pypdf2': lambda doc, pdf, rng, dest: get_mda.pdf_extract_range(pdf, 'bench', rng[0], rng[1], dest),
+        'fitz': lambda doc, pdf, rng, dest: get_mda.pdf_extract_range_fitz(doc, pdf, 'bench', rng[0], rng[1], dest),
+        'fitz_gc_deflate': lambda doc, pdf, rng, dest: get_mda.pdf_extract_range_fitz(doc, pdf, 'bench', rng[0],
+                                                                                       rng[1], dest, garbage=3,
+                                                                                       deflate=True),
+    }
+    totals = {engine: 0.0 for engine in engines}
+    page_count = 0
+    print(f"{'report':<60} {'pages':>9} " + " ".join(f"{engine:>16}" for engine in engines))
+    for pdf in pdf_list:
+        doc = fitz.open(pdf)
+        doc_outline = [element for element in doc.get_toc() if element[0] == 1]
+        page_range = None
+        if len(doc_outline) > 0:
+            mda_match, start_page, end_page = get_mda.find_mda_range(doc_outline)
+            if not isinstance(mda_match, list) and start_page not in [None, -1] and end_page not in [None, -1]:
+                page_range = (int(start_page), int(end_page))
+        if page_range is None:
+            page_range = (1, min(doc.page_count, 12))
+        page_count += page_range[1] - page_range[0] + 1
+
+        results = {}
+        for engine, extract in engines.items():
+            dest = os.path.join(tmp_path, engine)
+
+            def run():
+                """Removes the previous output so that the existence check does not short-cut the timed run"""
+                fpath = get_mda.mda_fpath(pdf, 'bench', page_range[0], page_range[1], dest)
+                if os.path.exists(fpath):
+                    os.remove(fpath)
+                extract(doc, pdf, page_range, dest)
+            results[engine] = best_of(repeat, run)
+            totals[engine] += results[engine]
+        doc.close()
+        print(f"{os.path.basename(pdf)[:60]:<60} {f'{page_range[0]}-{page_range[1]}':>9} "
+              + " ".join(f"{results[engine] * 1000:>14.1f}ms" for engine in engines))
+
+    print(f"{'total':<60} {'':>9} " + " ".join(f"{totals[engine] * 1000:>14.1f}ms" for engine in engines))
+    for engine in engines:
+        if engine != 'pypdf2' and totals[engine] > 0:
+            print(f"{engine} speedup over pypdf2: {totals['pypdf2'] / totals[engine]:.1f}x")
+    return {('pdf_extract_range' if engine == 'pypdf2' else f"pdf_extract_range_{engine}"):
+            step_result(totals[engine], len(pdf_list), page_count) for engine in engines}
+
+
+def step_result(seconds, docs, pages):
+    return {'seconds': seconds, 'docs': docs, 'pages': pages, 'docs_per_sec': docs / seconds if seconds else 0.0,
+            'pages_per_sec': pages / seconds if seconds else 0.0}
+
+
+def bench_hot_paths(pdf_list, mda_list, repeat, min_time):
+    """
+    Times each extraction step over every sample, with its input prepared beforehand so that only the step itself is
+    timed. fitz TOC load and find_mda_range run on the reports; extract_text (also with layout=True), extract_eng_chi
+    and clean_text on the MD&A PDFs. find_mda_range scores every title, without the title cache.
+    :return: dict of {step: {'seconds', 'docs', 'pages', 'docs_per_sec', 'pages_per_sec'}}, seconds being the
+    fastest run over all samples, out of at least `repeat` runs and min_time seconds
+    """
+    import fitz
+    from . import get_mda, extract_text
+
+    report_pages, outlines = 0, []
+    for pdf in pdf_list:
+        with fitz.open(pdf) as doc:
+            report_pages += doc.page_count
+            doc_outline = [element for element in doc.get_toc() if element[0] == 1]
+            if len(doc_outline) > 0:
+                outlines.append((doc_outline, doc.page_count))
+    mda_pages, page_lines, mda_texts = 0, [], []
+    for pdf in mda_list:
+        with fitz.open(pdf) as doc:
+            mda_pages += doc.page_count
+            page_lines += [extract_text.page_text(page).split("\n") for page in doc]
+            mda_texts.append(extract_text.extract_doc_text(doc))
+
+    def load_toc():
+        for pdf in pdf_list:
+            with fitz.open(pdf) as doc:
+                doc.get_toc()
+
+    def find_ranges():
+        cache = get_mda.TitleScoreCache(db_path=':memory:', max_size=0)
+        for doc_outline, _ in outlines:
+            get_mda.find_mda_range(doc_outline, cache=cache)
+
+    def extract_texts():
+        for pdf in mda_list:
+            extract_text.extract_text(pdf)
+
+    def extract_texts_layout():
+        for pdf in mda_list:
+            with fitz.open(pdf) as doc:
+                extract_text.extract_doc_text(doc, layout=True)
+
+    def split_lines():
+        for text_list in page_lines:
+            extract_text.extract_eng_chi(text_list)
+
+    def clean_texts():
+        for eng_text_list, chi_text_list in mda_texts:
+            extract_text.clean_text(eng_text_list, language='eng')
+            extract_text.clean_text(chi_text_list, language='chi')
+
+    steps = [('toc_load', load_toc, len(pdf_list), report_pages),
+             ('find_mda_range', find_ranges, len(outlines), sum(pages for _, pages in outlines)),
+             ('extract_text', extract_texts, len(mda_list), mda_pages),
+             ('extract_text_layout', extract_texts_layout, len(mda_list), mda_pages),
+             ('extract_eng_chi', split_lines, len(mda_list), mda_pages),
+             ('clean_text', clean_texts, len(mda_list), mda_pages)]
+    results = {}
+    print(f"{'step':<32} {'docs':>5} {'pages':>6} {'time':>10} {'docs/sec':>10} {'pages/sec':>10}")
+    for step, func, docs, pages in steps:
+        results[step] = step_result(autorange(repeat, min_time, func), docs, pages)
+        print(f"{step:<32} {docs:>5} {pages:>6} {results[step]['seconds'] * 1000:>8.1f}ms "
+              f"{results[step]['docs_per_sec']:>10.1f} {results[step]['pages_per_sec']:>10.1f}")
+    return results
+
+
+def bench_memory(pdf_list, tmp_path):
+    """
+    Measures the peak memory allocated by Python (tracemalloc) while extracting and cleaning the text of the largest
+    report, on its first quarter, half and all of its pages: as lists of lines in memory like extract_mda_text, and
+    streamed page by page like --stream. Memory allocated by MuPDF itself is not traced.
+    :return: list of {'pages', 'in_memory_bytes', 'streaming_bytes', 'in_memory_seconds', 'streaming_seconds'}
+    """
+    import fitz
+    from . import extract_text
+
+    def in_memory(doc, page_numbers):
+        eng_text_list, chi_text_list = extract_text.extract_doc_text(doc, page_numbers)
+        for language, text_list in [('eng', eng_text_list), ('chi', chi_text_list)]:
+            with open(os.path.join(tmp_path, f"memory_{language}.txt"), 'w') as f:
+                f.write(extract_text.clean_text(text_list, language))
+
+    def streaming(doc, page_numbers):
+        eng_spool, chi_spool = extract_text.spool_doc_text(doc, page_numbers)
+        for language, spool in [('eng', eng_spool), ('chi', chi_spool)]:
+            spool.write_clean(os.path.join(tmp_path, f"memory_{language}.txt"), language)
+            spool.close()
+
+    page_counts = {}
+    for pdf in pdf_list:
+        with fitz.open(pdf) as doc:
+            page_counts[pdf] = doc.page_count
+    pdf = max(page_counts, key=page_counts.get)
+    print(f"Peak memory of text extraction on {os.path.basename(pdf)}")
+    print(f"{'pages':>6} {'in memory':>12} {'streaming':>12} {'in memory':>12} {'streaming':>12}")
+    results = []
+    with fitz.open(pdf) as doc:
+        for share in [0.25, 0.5, 1]:
+            page_numbers = range(max(1, int(doc.page_count * share)))
+            result = {'pages': len(page_numbers)}
+            for name, func in [('in_memory', in_memory), ('streaming', streaming)]:
+                tracemalloc.start()
+                start_time = time.perf_counter()
+                func(doc, page_numbers)
+                result[f"{name}_seconds"] = time.perf_counter() - start_time
+                result[f"{name}_bytes"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            results.append(result)
+            print(f"{result['pages']:>6} {result['in_memory_bytes'] / 1024:>10.0f}KB "
+                  f"{result['streaming_bytes'] / 1024:>10.0f}KB {result['in_memory_seconds'] * 1000:>10.0f}ms "
+                  f"{result['streaming_seconds'] * 1000:>10.0f}ms")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the time per page of each step, so that a baseline taken on other samples still compares.
+    :return: names of the steps slower than the baseline by more than tolerance
+    """
+    regressions = []
+    print(f"{'step':<32} {'baseline':>12} {'current':>12} {'change':>8}")
+    for step, result in results['steps'].items():
+        if step not in baseline['steps'] or not result['pages'] or not baseline['steps'][step]['pages']:
+            continue
+        before = baseline['steps'][step]['seconds'] / baseline['steps'][step]['pages']
+        after = result['seconds'] / result['pages']
+        change = after / before - 1 if before else 0.0
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(step)
+        print(f"{step:<32} {before * 1000:>10.3f}ms {after * 1000:>10.3f}ms {change:>+8.0%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    print(f"per page; import {baseline['import_ms']:.1f}ms -> {results['import_ms']:.1f}ms")
+    return regressions
+
+
+def main():
+    bench_args = parse_args()
+    import_ms = bench_import(bench_args.repeat, bench_args.import_budget)
+    pdf_list = list_reports(bench_args.samples_path)
+    mda_list = list_reports(bench_args.samples_path, 'hkex_reports_mda')
+    if len(pdf_list) == 0:
+        raise Exception(f"No sample reports found under {bench_args.samples_path}/hkex_reports")
+    with tempfile.TemporaryDirectory() as tmp_path:
+        from . import utils
+        utils.config.load(['-t2', '40100', '-fd', '2022', '-td', '2022', '-dp', tmp_path])
+        steps = bench_extract_range(pdf_list, bench_args.repeat, tmp_path)
+        steps.update(bench_hot_paths(pdf_list, mda_list, bench_args.repeat, bench_args.min_time))
+        memory = bench_memory(pdf_list, tmp_path)
+        utils.config.metadata_db.close()
+        utils.config.state_db.close()
+    results = {'created': datetime.now().strftime('%Y%m%d %H:%M:%S'), 'python': platform.python_version(),
+               'machine': platform.platform(), 'repeat': bench_args.repeat, 'import_ms': import_ms, 'steps': steps,
+               'memory': memory}
+    if bench_args.json:
+        with open(bench_args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {bench_args.json}")
+    regressions = []
+    if bench_args.compare:
+        with open(bench_args.compare) as f:
+            regressions = compare(results, json.load(f), bench_args.tolerance)
+    if import_ms > bench_args.import_budget or len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
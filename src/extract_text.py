@@ -3,29 +3,50 @@ This script extracts and exports text from MD&A sections identified from extract
 last updated: July 2022
 """
 import os.path
-from bs4 import BeautifulSoup
 import re
 import os
 from collections import Counter
-import fitz
 import sqlite3
 import sys
+import tempfile
 import traceback
 import time
-from . import utils
-from .utils import module_path, download_path, reports_path, mda_path, mda_text_path, metadata_db, subfolders_required
-from .utils import module_start_time, t1codeVal, t2codeVal, from_date, to_date
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, islice, repeat
+from . import utils, metrics
+from .utils import config
 from .utils import logger
 
+INSERT_BATCH_SIZE = 100
+ASCII_LETTERS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+CHI_CHAR_PATTERN = re.compile(r'[\u4e00-\u9fa5！？。，：；《》「」『』－（）【】]')
+STANDALONE_PATTERN = re.compile(r'.*[^a-zA-Z]{1}$')
+LOWERCASE_PATTERN = re.compile(r'[a-z.]')
+DIGITS_PATTERN = re.compile(r'\d+')
+LAYOUT_MARGIN = 0.1  ## share of the page height (top and bottom) and width (sides) searched for running headers
+LAYOUT_MIN_SHARE = 0.3  ## share of the pages a header, footer or side tab recurs on
+SPOOL_CHUNK_LINES = 1000  ## lines cleaned and written at a time in --stream mode
 
-def get_mda_text(source_path, saveDoc_text):
-    cur = metadata_db.cursor()
+
+def get_mda_text(source_path, saveDoc_text, workers=1):
+    """
+    Extracts text from every MD&A PDF under source_path. With workers > 1 the files of each folder are handed out to
+    a process pool in chunks, and the returned rows are inserted into metadata_mda_text in batches.
+    :return: number of files processed
+    """
+    cur = config.metadata_db.cursor()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=utils.init_worker,
+                                   initargs=(config.args,)) if workers > 1 else None
+    file_count = 0
+    skipped_count = 0
+    reused_count = 0
 
     folderList = os.listdir(source_path)
     folderList.sort()
 
     for idx, folder in enumerate(folderList):
-        if not subfolders_required:
+        if not config.subfolders_required:
             fileList = folderList
             folder = ''
         else:
@@ -36,121 +57,484 @@ def get_mda_text(source_path, saveDoc_text):
             logger.info(f"Processing folder: {folder}")
             fileList = os.listdir(os.path.join(source_path, folder))
 
-        for file in fileList:
-            if not file.lower().endswith('pdf'):
-                continue
-            source_fpath = os.path.join(source_path, folder, file)
-            dest_path = os.path.join(saveDoc_text, folder)
-            if not os.path.exists(dest_path):
-                os.makedirs(dest_path)
-            eng_text_list, chi_text_list = extract_text(source_fpath)
+        candidates = [file for file in fileList if file.lower().endswith('pdf')]
+        pdf_list = [file for file in candidates
+                    if not utils.ledger_is_done('text', os.path.join(source_path, folder, file))]
+        skipped_count += len(candidates) - len(pdf_list)
+        file_count += len(pdf_list)
+        fpaths = [os.path.join(source_path, folder, file) for file in pdf_list]
+        hashes, originals = utils.find_duplicates('text', fpaths)
+        duplicates = [(file, sha256, original) for file, sha256, original in zip(pdf_list, hashes, originals)
+                      if original is not None]
+        hashes = [sha256 for sha256, original in zip(hashes, originals) if original is None]
+        pdf_list = [file for file, original in zip(pdf_list, originals) if original is None]
+        folder_start_time = time.time()
+        if executor is None:
+            rows = (extract_mda_text(source_path, folder, file, saveDoc_text) for file in pdf_list)
+        else:
+            chunksize = max(1, len(pdf_list) // (workers * 4))
+            rows = metrics.pool_map(executor, extract_mda_text, repeat(source_path), repeat(folder), pdf_list,
+                                    repeat(saveDoc_text), chunksize=chunksize)
+        batch = []
+        for file, sha256, row in zip(pdf_list, hashes, rows):
+            if row is not None:
+                batch.append(row)
+            utils.ledger_record('text', os.path.join(source_path, folder, file),
+                                status='success' if row is not None else 'exists', sha256=sha256)
+            if len(batch) >= INSERT_BATCH_SIZE:
+                insert_mda_text_rows(cur, batch)
+                batch = []
+
+        """MD&A PDFs with the same content as an earlier one, such as reused MD&A extractions, link its text files"""
+        for file, sha256, original in duplicates:
+            row = reuse_mda_text(source_path, folder, file, saveDoc_text, original)
+            if row is None:
+                row = extract_mda_text(source_path, folder, file, saveDoc_text)
+            else:
+                reused_count += 1
+            if row is not None:
+                batch.append(row)
+            utils.ledger_record('text', os.path.join(source_path, folder, file),
+                                status='success' if row is not None else 'exists', sha256=sha256)
+        insert_mda_text_rows(cur, batch)
+        utils.metadata_commit()
+        utils.ledger_commit()
+        folder_elapsed_time = time.time() - folder_start_time
+        if len(pdf_list) > 0:
+            logger.info(f"{folder} : {len(pdf_list)} files in {folder_elapsed_time:.2f}s "
+                        f"({len(pdf_list) / max(folder_elapsed_time, 1e-9):.2f} files/sec)")
+        if not config.subfolders_required:
+            break
+    if executor is not None:
+        executor.shutdown()
+    if skipped_count > 0:
+        logger.info(f"Skipped {skipped_count} MD&A files unchanged since their last text extraction")
+    if reused_count > 0:
+        logger.info(f"Reused the text of {reused_count} MD&A files with the same content as another MD&A file")
+    cur.close()
+    return file_count
+
+
+def extract_mda_text(source_path, folder, file, saveDoc_text):
+    """
+    Extracts and saves English and Chinese text of a single MD&A PDF.
+    :return: metadata_mda_text row as (file_name, saveDoc_text, folder, eng_extracted, chi_extracted), or None if
+    a text file already exists. With --force text, both text files are written again instead.
+    """
+    source_fpath = os.path.join(source_path, folder, file)
+    with metrics.document('text', source_fpath):
+        dest_path = os.path.join(saveDoc_text, folder)
+        if not os.path.exists(dest_path):
+            os.makedirs(dest_path, exist_ok=True)
+        eng_fname = file.replace(".pdf", "_ENG.txt")
+        eng_fpath = os.path.join(dest_path, eng_fname)
+        chi_fname = file.replace(".pdf", "_CHI.txt")
+        chi_fpath = os.path.join(dest_path, chi_fname)
+        """Either both text files are written, or neither is, so that the row always matches the files. Checked before
+        the PDF is read, so that unforced reruns do not parse it"""
+        if 'text' not in config.force_stages and (os.path.exists(eng_fpath) or os.path.exists(chi_fpath)):
+            return None
+        with metrics.registry.timer('text_extract_seconds', file=file):
+            eng_text_list, chi_text_list = extract_text(source_fpath, stream=config.stream)
 
+        try:
             """English text extraction"""
-            eng_fname = file.replace(".pdf", "_ENG.txt")
-            eng_fpath = os.path.join(dest_path, eng_fname)
-            if os.path.exists(eng_fpath):
-                continue
-            eng_text = clean_text(eng_text_list, language='eng')
-            if len(eng_text) > 0:
-                with open(eng_fpath, 'w') as f:
-                    f.write(eng_text)
-                    eng_extracted = True
-                    logger.info(f"{folder} : {eng_fname} : ENG : [Success]")
+            with metrics.registry.timer('text_clean_seconds', file=file, language='eng'):
+                eng_extracted = save_clean_text(eng_text_list, 'eng', eng_fpath)
+            if eng_extracted:
+                logger.info(f"{folder} : {eng_fname} : ENG : [Success]")
             else:
                 logger.info(f"{folder} : {eng_fname} : ENG : [Fail]")
-                eng_extracted = False
 
             """Chinese text extraction"""
-            chi_fname = file.replace(".pdf", "_CHI.txt")
-            chi_fpath = os.path.join(dest_path, chi_fname)
-            if os.path.exists(chi_fpath):
-                continue
-            chi_text = clean_text(chi_text_list, language='chi')
-            if len(chi_text) > 0:
-                with open(chi_fpath, 'w') as f:
-                    f.write(chi_text)
-                    logger.info(f"{folder} : {chi_fname} : CHI : [Success]")
-                    chi_extracted = True
+            with metrics.registry.timer('text_clean_seconds', file=file, language='chi'):
+                chi_extracted = save_clean_text(chi_text_list, 'chi', chi_fpath)
+            if chi_extracted:
+                logger.info(f"{folder} : {chi_fname} : CHI : [Success]")
             else:
                 logger.info(f"{folder} : {chi_fname} : CHI : [Failed]")
-                chi_extracted = False
-
-            query = f'''INSERT INTO metadata_mda_text VALUES (
-                    "{file.replace('.pdf', '')}", 
-                    "{saveDoc_text}", 
-                    "{folder}", 
-                    "{eng_extracted}", 
-                    "{chi_extracted}")'''
-            try:
-                cur.execute(query)
-            except sqlite3.OperationalError as e:
-                logger.debug(traceback.print_exception(*sys.exc_info()))
-        if not subfolders_required:
-            break
-    cur.close()
+        finally:
+            if config.stream:
+                eng_text_list.close()
+                chi_text_list.close()
+
+        return file.replace('.pdf', ''), saveDoc_text, folder, eng_extracted, chi_extracted
+
 
+def save_clean_text(text_list, language, fpath):
+    """
+    Cleans the lines of one language and writes them to fpath, unless the cleaned text is empty. An existing file is
+    replaced rather than written through, since it may be hardlinked to the text of another MD&A PDF, and removed if
+    the text is now empty.
+    :param text_list: list of lines, or a LineSpool in --stream mode
+    :return: whether the file was written
+    """
+    if isinstance(text_list, LineSpool):
+        extracted = text_list.write_clean(fpath, language, remove_repeated=not config.layout)
+    else:
+        cleaned_text = clean_text(text_list, language=language, remove_repeated=not config.layout)
+        extracted = len(cleaned_text) > 0
+        if extracted:
+            with open(fpath + '.part', 'w') as f:
+                f.write(cleaned_text)
+            os.replace(fpath + '.part', fpath)
+    if not extracted and os.path.exists(fpath):
+        os.remove(fpath)
+    return extracted
 
-def clean_text(text_list, language):
+
+def reuse_mda_text(source_path, folder, file, saveDoc_text, original_fpath):
+    """
+    Reuses the text files of an identical MD&A PDF by hardlinking them under this file's name.
+    :param original_fpath: path of the identical MD&A PDF under source_path, as recorded in the ledger
+    :return: metadata_mda_text row like extract_mda_text, or None if the identical file's text files are gone
+    """
+    original_path = os.path.join(saveDoc_text, os.path.relpath(os.path.dirname(original_fpath), source_path))
+    original_file = os.path.basename(original_fpath)
+    dest_path = os.path.join(saveDoc_text, folder)
+    extracted = []
+    for language in ['ENG', 'CHI']:
+        original_text_fpath = os.path.join(original_path, original_file.replace(".pdf", f"_{language}.txt"))
+        text_fpath = os.path.join(dest_path, file.replace(".pdf", f"_{language}.txt"))
+        if os.path.exists(original_text_fpath) and not os.path.exists(text_fpath):
+            os.makedirs(dest_path, exist_ok=True)
+            utils.link_file(original_text_fpath, text_fpath)
+        extracted.append(os.path.exists(original_text_fpath))
+    if not any(extracted):
+        return None
+    logger.info(f"{folder} : {file} : [Same content as {original_file}]")
+    metrics.registry.inc('reused_total', stage='text')
+    return file.replace('.pdf', ''), saveDoc_text, folder, extracted[0], extracted[1]
+
+
+def insert_mda_text_rows(cur, rows):
+    if len(rows) == 0:
+        return
+    query = "INSERT INTO metadata_mda_text VALUES (?, ?, ?, ?, ?)"
+    params = [(file_name, saveDoc_text, folder, str(eng_extracted), str(chi_extracted))
+              for file_name, saveDoc_text, folder, eng_extracted, chi_extracted in rows]
+    try:
+        with utils.db_lock:
+            cur.executemany(query, params)
+    except sqlite3.OperationalError as e:
+        logger.debug(traceback.print_exception(*sys.exc_info()))
+
+
+def clean_text(text_list, language, remove_repeated=True):
+    """
+    Joins the lines of one language into the text saved, dropping repeated headers and footers and, for English,
+    titles and capitalized lines. Each filter is a generator, so the lines are cleaned in a single pass.
+    :param language: 'eng' or 'chi'
+    :param remove_repeated: drops the most repeated lines as headers and footers. Not needed for text extracted with
+    layout=True, whose headers and footers are dropped by position.
+    """
+    if remove_repeated:
+        text_list = remove_duplicates(text_list)
     if language == 'chi':
-       duplicates_removed = remove_duplicates(text_list)
-       cleaned_text = "".join(duplicates_removed)
+        cleaned_text = "".join(text_list)
     elif language == 'eng':
-        duplicates_removed = remove_duplicates(text_list)
-        standalones_removed = remove_standalone_text(duplicates_removed)
-        capitals_removed = remove_capitalized_text(standalones_removed)
-        cleaned_text = "".join(capitals_removed)
-        if re.findall(r'[\u4e00-\u9fa5！？。，：；《》「」『』－（）【】]+', cleaned_text) is not None:
-            cleaned_text = re.sub(r'[\u4e00-\u9fa5！？。，：；《》「」『』－（）【】]', ' ', cleaned_text)
+        cleaned_text = "".join(remove_capitalized_text(remove_standalone_text(text_list)))
+        if not cleaned_text.isascii():
+            cleaned_text = CHI_CHAR_PATTERN.sub(' ', cleaned_text)
     else:
         cleaned_text = ""
     if "\t" in cleaned_text:
         cleaned_text = cleaned_text.replace("\t", " ")
-    cleaned_text = re.sub(r' {2,}', ' ', cleaned_text)
+    cleaned_text = collapse_spaces(cleaned_text)
 
     return cleaned_text
 
 
-def extract_text(source_fpath):
+def collapse_spaces(text):
+    """Halving runs of spaces until none are left gives the same text as re.sub(r' {2,}', ' ', ...), in fewer steps"""
+    while "  " in text:
+        text = text.replace("  ", " ")
+    return text
+
+
+def extract_text(source_fpath, stream=False):
+    """
+    :param stream: reads the pages one at a time into LineSpools, see spool_doc_text
+    :return: (eng_text_list, chi_text_list), as lists of lines or LineSpools
+    """
+    import fitz
     doc = fitz.open(source_fpath)
-    doc_text = [BeautifulSoup(doc.load_page(pageNum).get_text('text'), 'html.parser').text for pageNum in range(doc.page_count)]
+    metrics.annotate(pages=doc.page_count)
+    if stream:
+        with doc:
+            return spool_doc_text(doc, layout=config.layout)
+    return extract_doc_text(doc, layout=config.layout)
+
+
+def extract_doc_text(doc, page_numbers=None, layout=False):
+    """
+    Splits the text of an opened fitz document into English and Chinese lines.
+    :param page_numbers: 0-based pages to read, every page if None
+    :param layout: drops running headers and footers by their position on the page, see layout_page_texts
+    :return: (eng_text_list, chi_text_list)
+    """
+    if page_numbers is None:
+        page_numbers = range(doc.page_count)
+    if layout:
+        doc_text = layout_page_texts(doc, page_numbers)
+    else:
+        doc_text = [page_text(doc.load_page(pageNum)) for pageNum in page_numbers]
 
-    eng_text_all = []
-    chi_text_all = []
-    for idx, page in enumerate(doc_text):
-        text_list = page.split("\n")
-        eng_text_list, chi_text_list, other_text_list = extract_eng_chi(text_list)
-        eng_text_all += eng_text_list
-        chi_text_all += chi_text_list
+    """The lines of all pages are classified at once, in the same order as page by page"""
+    text_list = [line for page in doc_text for line in page.split("\n")]
+    eng_text_all, chi_text_all, other_text_all = extract_eng_chi(text_list)
 
     return eng_text_all, chi_text_all
 
 
+def page_text(page):
+    """
+    :return: text of a fitz page, parsed as HTML by BeautifulSoup as before. Text without markup, entities or
+    anything but whitespace comes back from it unchanged, so it is only parsed when it has one of those.
+    """
+    text = page.get_text('text')
+    if '<' in text or '&' in text or text.isspace():
+        from bs4 import BeautifulSoup
+        text = BeautifulSoup(text, 'html.parser').text
+    return text
+
+
+def margin_band(block, rect):
+    """:return: 'top', 'bottom', 'left' or 'right' if the block lies within that margin of the page, else None"""
+    x0, y0, x1, y1 = block[:4]
+    if y1 <= rect.y0 + rect.height * LAYOUT_MARGIN:
+        return 'top'
+    if y0 >= rect.y1 - rect.height * LAYOUT_MARGIN:
+        return 'bottom'
+    if x1 <= rect.x0 + rect.width * LAYOUT_MARGIN:
+        return 'left'
+    if x0 >= rect.x1 - rect.width * LAYOUT_MARGIN:
+        return 'right'
+    return None
+
+
+def page_blocks(page):
+    """
+    :return: list of (key, text) of the text blocks of a page. key is (margin band, text with whitespace normalized
+    and numbers masked) for blocks within a margin, else None.
+    """
+    rect = page.rect
+    blocks = []
+    for block in page.get_text('blocks'):
+        if block[6] != 0:
+            continue
+        band = margin_band(block, rect)
+        key = (band, DIGITS_PATTERN.sub('#', " ".join(block[4].split()))) if band is not None else None
+        blocks.append((key, block[4]))
+    return blocks
+
+
+def running_keys(page_keys, page_count):
+    """
+    :param page_keys: iterable of the block keys of each page, as in page_blocks
+    :return: set of the keys recurring on at least LAYOUT_MIN_SHARE of the pages, and on two pages or more
+    """
+    page_counts = Counter(key for keys in page_keys for key in set(keys) if key is not None)
+    min_pages = max(2, LAYOUT_MIN_SHARE * page_count)
+    return {key for key, count in page_counts.items() if count >= min_pages}
+
+
+def layout_page_texts(doc, page_numbers):
+    """
+    Reads the text blocks of each page once and drops the running headers, footers and side tabs: blocks lying within
+    a margin of the page whose text, with numbers masked, recurs in the same margin on at least LAYOUT_MIN_SHARE of
+    the pages (and on two pages or more), such as report titles, section names and page numbers.
+    :return: list of the remaining text of each page, in the order of get_text('text')
+    """
+    pages = [page_blocks(doc.load_page(pageNum)) for pageNum in page_numbers]
+    running = running_keys(([key for key, text in blocks] for blocks in pages), len(pages))
+    return ["".join(text for key, text in blocks if key not in running) for blocks in pages]
+
+
+def iter_page_texts(doc, page_numbers, layout=False):
+    """
+    Yields the text of each page like extract_doc_text reads it, holding one page at a time. With layout, the blocks
+    are read twice: once to find the running headers and footers, and once to yield the rest.
+    """
+    if not layout:
+        for pageNum in page_numbers:
+            yield page_text(doc.load_page(pageNum))
+        return
+    running = running_keys(([key for key, text in page_blocks(doc.load_page(pageNum))] for pageNum in page_numbers),
+                           len(page_numbers))
+    for pageNum in page_numbers:
+        yield "".join(text for key, text in page_blocks(doc.load_page(pageNum)) if key not in running)
+
+
+def spool_doc_text(doc, page_numbers=None, layout=False):
+    """
+    Streaming counterpart of extract_doc_text. The pages are read and split one at a time, and their English and
+    Chinese lines written to temporary files, so that memory does not grow with the page count.
+    :return: (eng_spool, chi_spool) LineSpools, to be closed by the caller
+    """
+    if page_numbers is None:
+        page_numbers = range(doc.page_count)
+    eng_spool, chi_spool = LineSpool(), LineSpool()
+    try:
+        for text in iter_page_texts(doc, page_numbers, layout):
+            eng_text_list, chi_text_list, other_text_list = extract_eng_chi(text.split("\n"))
+            eng_spool.extend(eng_text_list)
+            chi_spool.extend(chi_text_list)
+    except Exception:
+        eng_spool.close()
+        chi_spool.close()
+        raise
+    return eng_spool, chi_spool
+
+
+class LineSpool:
+    """
+    Lines of one language of a document, kept in a temporary file. Only a 64-bit hash per line is kept in memory, to
+    find the lines remove_duplicates drops without holding the document's text.
+    """
+    def __init__(self):
+        """Lines never hold '\n', so reading with newline='\n' splits them back exactly"""
+        self.file = tempfile.TemporaryFile('w+', encoding='utf-8', errors='surrogatepass', newline='\n')
+        self.hashes = array('q')
+
+    def extend(self, lines):
+        self.file.writelines(line + "\n" for line in lines)
+        self.hashes.extend(map(hash, lines))
+
+    def __iter__(self):
+        self.file.seek(0)
+        for line in self.file:
+            yield line[:-1]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def close(self):
+        self.file.close()
+
+    def repeated_lines(self):
+        """
+        :return: set of the lines remove_duplicates drops, found by counting hashes. If two of the lines found share
+        a hash, the lines themselves are counted instead.
+        """
+        import numpy as np
+        if len(self.hashes) == 0:
+            return set()
+        unique, first, counts = np.unique(np.frombuffer(self.hashes, dtype=np.int64), return_index=True,
+                                          return_counts=True)
+        """Ordered by count and then first occurrence, like Counter.most_common"""
+        order = np.lexsort((first, -counts))[:10]
+        top_hashes = most_repeated(Counter({int(unique[idx]): int(counts[idx]) for idx in order}))
+        repeated = {}
+        for line in self:
+            line_hash = hash(line)
+            if line_hash in top_hashes and repeated.setdefault(line_hash, line) != line:
+                return most_repeated(Counter(self))
+        return set(repeated.values())
+
+    def write_clean(self, fpath, language, remove_repeated=True):
+        """
+        Streaming counterpart of clean_text: cleans the lines SPOOL_CHUNK_LINES at a time and writes them to fpath,
+        giving the same text.
+        :return: whether any text was written. fpath is not created otherwise.
+        """
+        repeated = self.repeated_lines() if remove_repeated else set()
+        lines = (line for line in self if line not in repeated)
+        if language == 'eng':
+            lines = remove_capitalized_text(remove_standalone_text(lines))
+        elif language != 'chi':
+            lines = iter(())
+        part_fpath = fpath + '.part'
+        written = False
+        space_ended = False
+        with open(part_fpath, 'w') as f:
+            for chunk in iter(lambda: list(islice(lines, SPOOL_CHUNK_LINES)), []):
+                text = "".join(chunk)
+                if language == 'eng' and not text.isascii():
+                    text = CHI_CHAR_PATTERN.sub(' ', text)
+                text = collapse_spaces(text.replace("\t", " "))
+                if space_ended:
+                    """A run of spaces spanning two chunks is collapsed too"""
+                    text = text.lstrip(' ')
+                if len(text) > 0:
+                    f.write(text)
+                    written = True
+                    space_ended = text.endswith(' ')
+        if written:
+            os.replace(part_fpath, fpath)
+        else:
+            os.remove(part_fpath)
+        return written
+
+
 def extract_eng_chi(text_list):
+    """
+    Splits lines into English and Chinese ones, by whether they have more English or more Chinese characters.
+    :return: (eng_text_list, chi_text_list, other_text_list). Lines with neither, or as many of each, are other.
+    """
     text_list = [element for element in text_list if len(element) != 0]
-    eng_text_list = []
-    chi_text_list = []
-    other_text_list = []
-    for idx, text in enumerate(text_list):
-        eng = re.findall(r'[a-zA-Z?!()\[\]{}<>]{1}', text)
-        chi = re.findall(r'[\u4e00-\u9fa5！？。，：；《》「」『』－（）【】]{1}', text)
-        other = re.findall(r'[^a-zA-Z\u4e00-\u9fa5]{1}', text)
-        if len(eng) == 0 and len(chi) == 0:
-            other_text_list.append(text)
-        elif (len(eng) - len(chi)) > 0:
-            eng_text_list.append(text)
-        elif (len(chi) - len(eng)) > 0:
-            chi_text_list.append(text)
-        else:
-            other_text_list.append(text)
+    scores = language_scores(text_list)
+    eng_text_list = list(compress(text_list, (scores > 0).tolist()))
+    chi_text_list = list(compress(text_list, (scores < 0).tolist()))
+    other_text_list = list(compress(text_list, (scores == 0).tolist()))
     return eng_text_list, chi_text_list, other_text_list
 
 
+char_classes = None
+
+
+def char_class_table():
+    """
+    :return: numpy array indexed by codepoint, 1 for English characters ([a-zA-Z?!()\[\]{}<>]), -1 for Chinese ones
+    ([\u4e00-\u9fa5！？。，：；《》「」『』－（）【】]) and 0 for all others. Built on first use.
+    """
+    global char_classes
+    if char_classes is None:
+        import numpy as np
+        table = np.zeros(sys.maxunicode + 1, dtype=np.int8)
+        for char in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ?!()[]{}<>':
+            table[ord(char)] = 1
+        table[0x4e00:0x9fa5 + 1] = -1
+        for char in '！？。，：；《》「」『』－（）【】':
+            table[ord(char)] = -1
+        char_classes = table
+    return char_classes
+
+
+def language_scores(text_list):
+    """
+    Counts the English minus the Chinese characters of every line in a single pass: the lines are joined, their
+    codepoints looked up in char_class_table, and the running sum is read off at the end of each line.
+    :param text_list: lines of a page or of a whole document
+    :return: numpy array with the score of each line. Positive is English, negative Chinese.
+    """
+    import numpy as np
+    codepoints = np.frombuffer("".join(text_list).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    running = np.zeros(len(codepoints) + 1, dtype=np.int32)
+    np.cumsum(char_class_table().take(codepoints), out=running[1:])
+    ends = np.zeros(len(text_list) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, text_list), dtype=np.int64, count=len(text_list)), out=ends[1:])
+    return np.diff(running[ends])
+
+
 def remove_duplicates(text_list):
-    most_common = Counter(text_list).most_common(10)
-    top_repeated_text_counts = sorted(list(set([element[1] for element in most_common])), reverse=True)[:2]
-    top_repeated_texts = [element[0] for element in most_common if element[1] in top_repeated_text_counts]
-    removed = [text for text in text_list if text not in top_repeated_texts]
-    return removed
+    """
+    Drops the lines repeated most often, such as page headers and footers: those among the 10 most common lines that
+    have one of the two highest counts.
+    :return: generator of the remaining lines
+    """
+    top_repeated_texts = most_repeated(Counter(text_list))
+    return (text for text in text_list if text not in top_repeated_texts)
+
+
+def most_repeated(counts):
+    """
+    :param counts: Counter of lines, or of their hashes
+    :return: set of the keys among the 10 most common that have one of the two highest counts
+    """
+    most_common = counts.most_common(10)
+    top_repeated_text_counts = sorted(set(element[1] for element in most_common), reverse=True)[:2]
+    return {element[0] for element in most_common if element[1] in top_repeated_text_counts}
 
 
 def remove_standalone_text(text_list):
@@ -159,32 +543,44 @@ def remove_standalone_text(text_list):
     Example: 'Management Discussion and Analysis'], ['Analysis'], ['Management Discussion and Analysis'],
     ['Overall Performance'], ['Windsor Pavilion, Yantai'], ['Property Rental'], ['Other Operations']
     :param text_list:
-    :return:
+    :return: generator of the other texts, stripped and followed by a space
     """
-    removed = [re.findall(r'.*[^a-zA-Z]{1}$', text) for text in text_list]
-    flattened_list = [element[0].strip()+" " for element in removed if len(element) != 0]
-    return flattened_list
+    for text in text_list:
+        if "\n" not in text:
+            """Without line breaks, the pattern matches the whole text if it ends in anything but a letter"""
+            if len(text) != 0 and text[-1] not in ASCII_LETTERS:
+                yield text.strip() + " "
+        else:
+            removed = STANDALONE_PATTERN.findall(text)
+            if len(removed) != 0:
+                yield removed[0].strip() + " "
 
 
 def remove_capitalized_text(text_list):
-    capitalized_texts = [text for text in text_list if not re.search(r'[a-z.]', text)]
-    removed = [element for element in text_list if element not in capitalized_texts]
-    return removed
+    """:return: generator of the texts with a lowercase letter or a period"""
+    return (text for text in text_list if LOWERCASE_PATTERN.search(text))
 
 
+@metrics.profiled('text')
 def main():
     logger.info('Start text extraction')
     script_start_time = time.time()
     utils.init_db_mda_text()
-    if not os.path.exists(mda_text_path):
-        os.makedirs(mda_text_path)
-    get_mda_text(mda_path, saveDoc_text=mda_text_path)
-    metadata_db.commit()
+    utils.migrate_daily_dbs()
+    utils.init_db_ledger()
+    if not os.path.exists(config.mda_text_path):
+        os.makedirs(config.mda_text_path)
+    file_count = get_mda_text(config.mda_path, saveDoc_text=config.mda_text_path, workers=config.workers)
+    config.metadata_db.commit()
     elapsed_time = time.time() - script_start_time
+    metrics.registry.observe('stage_seconds', elapsed_time, stage='text')
     logger.info(f"MD&A text extraction complete. Elapsed time: {elapsed_time}")
+    logger.info(f"Text extraction throughput: {file_count / max(elapsed_time, 1e-9):.2f} files/sec "
+                f"over {file_count} files with {config.workers} worker(s)")
     logger.info('=' * 65)
     return True
 
 
 if __name__ == "__main__":
+    config.load()
     main()
\ No newline at end of file
@@ -0,0 +1,259 @@
+"""
+This script runs a local stand-in for the HKEXnews endpoints used by this module, so that downloads can be load tested
+and retries exercised offline. It answers the title search (titleSearchServlet.do), the stock code prefix search
+(prefix.do) and the file links of the filings it lists, with configurable latency, error rate and throttling.
+Filings are the sample reports in reports_data, or rows recorded from a real search. GET /stats returns the request
+counters as JSON.
+Usage: python -m hkex-text-mda.src.fake_hkex [--port 8480] [--catalogue FILE] [--latency MS] [--error_rate P]
+Then run the module with --base_url http://127.0.0.1:8480
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+module_path = os.path.dirname(os.path.abspath(__file__))
+default_samples_path = os.path.join(os.path.dirname(module_path), 'reports_data')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serves a local stand-in for the HKEXnews search and file links.")
+    parser.add_argument("--port", "-p", required=False, type=int, default=8480, help="Default: 8480")
+    parser.add_argument("--samples_path", "-s", required=False, default=default_samples_path,
+                        help="Directory holding an 'hkex_reports' folder of sample reports. Default: ./reports_data")
+    parser.add_argument("--catalogue", "-ct", required=False,
+                        help="JSON file of recorded search rows (the parsed 'result' of titleSearchServlet.do) to list "
+                             "instead of the samples. Each FILE_LINK is served with the sample named after its NEWS_ID "
+                             "if there is one, else with the samples in turn.")
+    parser.add_argument("--copies", "-cp", required=False, type=int, default=1,
+                        help="Number of times the samples are listed, each copy a day earlier with new NEWS_IDs, to "
+                             "load test with more filings than there are samples. Default: 1")
+    parser.add_argument("--latency", "-l", required=False, type=float, default=0,
+                        help="Milliseconds added to every response. Default: 0")
+    parser.add_argument("--jitter", "-j", required=False, type=float, default=0,
+                        help="Up to this many more milliseconds, drawn uniformly per response. Default: 0")
+    parser.add_argument("--slow_rate", "-sr", required=False, type=float, default=0,
+                        help="Share of responses delayed by --slow_latency on top, for tail latency. Default: 0")
+    parser.add_argument("--slow_latency", "-sl", required=False, type=float, default=2000,
+                        help="Milliseconds added to slow responses. Default: 2000")
+    parser.add_argument("--error_rate", "-er", required=False, type=float, default=0,
+                        help="Share of requests answered with 500 instead. Default: 0")
+    parser.add_argument("--throttle", "-th", required=False, type=float, default=0,
+                        help="Requests per second served before further ones are answered with 429, like a host "
+                             "enforcing a rate limit. 0 disables throttling. Default: 0")
+    parser.add_argument("--seed", required=False, type=int, default=0,
+                        help="Seed of the latency and error draws, so that runs are repeatable. Default: 0")
+    return parser.parse_args(argv)
+
+
+def sample_catalogue(samples_path, copies=1):
+    """
+    Lists the sample reports as search rows, parsing the stock code, NEWS_ID, date and title back out of the names
+    get_report.report_filename gave them.
+    :return: (rows, files) with files mapping each FILE_LINK to the local file served for it
+    """
+    fpaths = []
+    for root, dirs, files in os.walk(os.path.join(samples_path, 'hkex_reports')):
+        fpaths += [os.path.join(root, file) for file in files]
+    rows, files = [], {}
+    for copy in range(copies):
+        for idx, fpath in enumerate(sorted(fpaths)):
+            match = re.match(r'(.*?)_(\d+)_(\d{8})_(.*)\.(\w+)$', os.path.basename(fpath))
+            if match is None:
+                continue
+            stock_code, news_id, date, title, extension = match.groups()
+            date_time = datetime.strptime(date, '%Y%m%d') + timedelta(days=-copy, hours=16, minutes=idx)
+            news_id = str(int(news_id) + copy * 100000000)
+            file_link = f"/listedco/listconews/sehk/{date_time:%Y/%m%d}/{news_id}.{extension.lower()}"
+            rows.append({'FILE_INFO': f"{os.path.getsize(fpath) // 1024}KB", 'NEWS_ID': news_id,
+                         'SHORT_TEXT': 'Financial Statements/ESG Information', 'TOTAL_COUNT': '',
+                         'DOD_WEB_PATH': '', 'STOCK_NAME': f"STOCK {stock_code}",
+                         'TITLE': title.replace('-', ' '), 'FILE_TYPE': '' if extension == 'txt' else extension.upper(),
+                         'DATE_TIME': date_time.strftime('%d/%m/%Y %H:%M'), 'LONG_TEXT': 'Annual Report',
+                         'STOCK_CODE': stock_code.replace('.', '<br/>'), 'FILE_LINK': file_link})
+            files[file_link] = fpath
+    return rows, files
+
+
+def recorded_catalogue(catalogue_path, samples_path):
+    """:return: (rows, files) as in sample_catalogue, for rows recorded from a real search"""
+    with open(catalogue_path) as f:
+        rows = json.load(f)
+    sample_rows, sample_files = sample_catalogue(samples_path)
+    by_news_id = {row['NEWS_ID']: sample_files[row['FILE_LINK']] for row in sample_rows}
+    samples = sorted(sample_files.values())
+    files = {}
+    for idx, row in enumerate(rows):
+        files[row['FILE_LINK']] = by_news_id.get(str(row['NEWS_ID']), samples[idx % len(samples)])
+    return rows, files
+
+
+def stock_ids(rows):
+    """:return: dict of stockId by stock code, one per counter of each listed stock"""
+    ids = {}
+    for row in rows:
+        for code in re.split(r'<.*?>', row['STOCK_CODE']):
+            if code and code not in ids:
+                ids[code] = 1000000 + int(code)
+    return ids
+
+
+class FakeHKEX:
+    """
+    Filings, fault settings and request counters shared by the handler threads of one server.
+    """
+    def __init__(self, rows, files, latency=0, jitter=0, slow_rate=0, slow_latency=2000, error_rate=0, throttle=0,
+                 seed=0):
+        self.rows = sorted(rows, key=lambda row: datetime.strptime(row['DATE_TIME'], '%d/%m/%Y %H:%M'), reverse=True)
+        self.files = files
+        self.stock_ids = stock_ids(rows)
+        self.latency, self.jitter = latency, jitter
+        self.slow_rate, self.slow_latency = slow_rate, slow_latency
+        self.error_rate, self.throttle = error_rate, throttle
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start, self.window_count = 0.0, 0
+        self.stats = {'search': 0, 'prefix': 0, 'file': 0, 'not_found': 0, 'errors': 0, 'throttled': 0,
+                      'bytes': 0}
+
+    def fault(self):
+        """
+        Draws the delay and outcome of a request.
+        :return: (delay in seconds, None or the status code to answer with instead)
+        """
+        with self.lock:
+            delay = (self.latency + self.random.uniform(0, self.jitter)) / 1000
+            if self.random.random() < self.slow_rate:
+                delay += self.slow_latency / 1000
+            if self.throttle:
+                now = time.monotonic()
+                if now - self.window_start >= 1:
+                    self.window_start, self.window_count = now, 0
+                self.window_count += 1
+                if self.window_count > self.throttle:
+                    self.stats['throttled'] += 1
+                    return delay, 429
+            if self.random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                return delay, 500
+        return delay, None
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def search(self, params):
+        """Lists the filings of a date range, newest first, like titleSearchServlet.do"""
+        from_date = datetime.strptime(params['fromDate'], '%Y%m%d')
+        to_date = datetime.strptime(params['toDate'], '%Y%m%d') + timedelta(days=1)
+        stock_id = int(params.get('stockId', -1))
+        matches = []
+        for row in self.rows:
+            date_time = datetime.strptime(row['DATE_TIME'], '%d/%m/%Y %H:%M')
+            codes = re.split(r'<.*?>', row['STOCK_CODE'])
+            if from_date <= date_time < to_date and (stock_id == -1 or stock_id in
+                                                     [self.stock_ids.get(code) for code in codes]):
+                matches.append(row)
+        page = matches[:int(params.get('rowRange', 100))]
+        return {'genDate': datetime.now().strftime('%Y%m%d%H%M%S'), 'maxNumOfFile': 100, 'recordCnt': len(matches),
+                'loadedRecord': len(page), 'hasNextRow': len(matches) > len(page), 'result': json.dumps(page)}
+
+    def prefix(self, params):
+        """Looks a stock code up like prefix.do, whose JSON comes wrapped in a callback"""
+        code = str(params.get('name', '0')).zfill(5)
+        stock_info = [{'stockId': self.stock_ids.get(code, 1000000 + int(code)), 'code': code,
+                       'name': f"STOCK {code}"}]
+        return f"{params.get('callback', 'callback')}({json.dumps({'more': '0', 'stockInfo': stock_info})});\n"
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body, content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path == '/stats':
+                with fake.lock:
+                    return self.reply(200, json.dumps(fake.stats).encode())
+            delay, status = fake.fault()
+            time.sleep(delay)
+            if status is not None:
+                return self.reply(status, b'{"error": "injected"}')
+            if url.path.endswith('/titleSearchServlet.do'):
+                fake.count('search')
+                return self.reply(200, json.dumps(fake.search(params)).encode())
+            if url.path.endswith('/prefix.do'):
+                fake.count('prefix')
+                return self.reply(200, fake.prefix(params).encode(), 'text/javascript')
+            if url.path not in fake.files:
+                fake.count('not_found')
+                return self.reply(404, b'Not Found', 'text/plain')
+            with open(fake.files[url.path], 'rb') as f:
+                body = f.read()
+            fake.count('file')
+            fake.count('bytes', len(body))
+            self.reply(200, body, 'application/pdf' if url.path.endswith('.pdf') else 'text/plain')
+    return Handler
+
+
+def file_hashes(files):
+    """:return: dict of the SHA-256 served for each FILE_LINK, to check downloads against"""
+    hashes = {}
+    for file_link, fpath in files.items():
+        with open(fpath, 'rb') as f:
+            hashes[file_link] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def start_server(fake, port=0):
+    """
+    Serves fake on a background thread.
+    :param port: 0 picks a free port
+    :return: (server, base_url). server.shutdown() stops it.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake_hkex', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main(argv=None):
+    server_args = parse_args(argv)
+    if server_args.catalogue:
+        rows, files = recorded_catalogue(server_args.catalogue, server_args.samples_path)
+    else:
+        rows, files = sample_catalogue(server_args.samples_path, server_args.copies)
+    fake = FakeHKEX(rows, files, server_args.latency, server_args.jitter, server_args.slow_rate,
+                    server_args.slow_latency, server_args.error_rate, server_args.throttle, server_args.seed)
+    server = ThreadingHTTPServer(('127.0.0.1', server_args.port), make_handler(fake))
+    dates = sorted(datetime.strptime(row['DATE_TIME'], '%d/%m/%Y %H:%M') for row in rows)
+    print(f"Serving {len(rows)} filings from {dates[0]:%Y%m%d} to {dates[-1]:%Y%m%d} on "
+          f"http://127.0.0.1:{server_args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
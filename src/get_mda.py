@@ -3,30 +3,46 @@ This script finds and extracts only MD&A from reports using their outline, then
 Last updated: July 2022
 """
 import os.path
-import pandas as pd
-import PyPDF2
 from pathlib import Path
 import os
 import sqlite3
-from thefuzz import fuzz, process
-import fitz
+from rapidfuzz import fuzz as rf_fuzz, process as rf_process
+from thefuzz import fuzz, utils as fuzz_utils
 import time
 import traceback
 import sys
-from . import utils
-from .utils import module_path, download_path, reports_path, mda_path, metadata_db, subfolders_required
-from .utils import module_start_time, t1codeVal, t2codeVal, from_date, to_date
+import json
+import hashlib
+import importlib.metadata
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from . import utils, metrics
+from .utils import config
 from .utils import logger
 
 
-def get_mda(source_path, saveDoc_mda):
-    cur = metadata_db.cursor()
+def get_mda(source_path, saveDoc_mda, workers=1):
+    """
+    Extracts MD&A from every report under source_path. With workers > 1 the reports of each folder are spread over a
+    process pool, and the resulting rows are written to metadata_mda by this process only.
+    """
+    cur = config.metadata_db.cursor()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=utils.init_worker,
+                                   initargs=(config.args,)) if workers > 1 else None
+    skipped_count = 0
+    cache_hits, cache_misses = title_cache.totals()
+    prior_titles = load_prior_titles()
+    shortcut_tries = shortcut_hits = 0
+    reused_count = 0
 
     folderList = os.listdir(source_path)
     folderList.sort()
 
     for idx, folder in enumerate(folderList):
-        if not subfolders_required:
+        if not config.subfolders_required:
             fileList = folderList
             folder = ''
         else:
@@ -41,74 +57,183 @@ def get_mda(source_path, saveDoc_mda):
             logger.info(f"Processing folder: {folder}")
             fileList = os.listdir(os.path.join(source_path, folder))
 
-        for file in fileList:
-            if not file.lower().endswith('pdf'):
-                continue
-            pdfname = os.path.join(source_path, folder, file)
-            outline = 'error'
-            mda_extracted = 'false'
-            mda_title = None
-            dest_fpath = ''
-            try:
+        candidates = [file for file in fileList if file.lower().endswith('pdf')]
+        pdf_list = [file for file in candidates
+                    if not utils.ledger_is_done('mda', os.path.join(source_path, folder, file))]
+        skipped_count += len(candidates) - len(pdf_list)
+        fpaths = [os.path.join(source_path, folder, file) for file in pdf_list]
+        hashes, originals = utils.find_duplicates('mda', fpaths)
+        duplicates = [(file, sha256, original) for file, sha256, original in zip(pdf_list, hashes, originals)
+                      if original is not None]
+        hashes = [sha256 for sha256, original in zip(hashes, originals) if original is None]
+        pdf_list = [file for file, original in zip(pdf_list, originals) if original is None]
+        prior_list = [prior_titles.get(file.split("_")[0]) for file in pdf_list]
+        if executor is None:
+            rows = (extract_mda(source_path, folder, file, saveDoc_mda, prior_title)
+                    for file, prior_title in zip(pdf_list, prior_list))
+        else:
+            chunksize = max(1, len(pdf_list) // (workers * 4))
+            rows = metrics.pool_map(executor, extract_mda, repeat(source_path), repeat(folder), pdf_list,
+                                    repeat(saveDoc_mda), prior_list, chunksize=chunksize)
+        mda_rows = []
+        for file, sha256, prior_title, row in zip(pdf_list, hashes, prior_list, rows):
+            if prior_title is not None:
+                """The matched title is always an outline title, so it equals the prior one only if the shortcut hit"""
+                shortcut_tries += 1
+                if row[6] and normalize_title(row[6]) == normalize_title(prior_title):
+                    shortcut_hits += 1
+            if row[-1] == 'success':
+                prior_titles[row[3]] = row[6]
+            mda_rows.append(row)
+            utils.ledger_record('mda', os.path.join(source_path, folder, file), status=row[-1], output=row[1],
+                                sha256=sha256)
+        insert_mda_rows(cur, mda_rows)
+
+        """Reports with the same content as an earlier one reuse its row, which is in metadata_mda by now"""
+        mda_rows = []
+        for file, sha256, original in duplicates:
+            row = reuse_mda(folder, file, saveDoc_mda, original)
+            if row is None:
+                row = extract_mda(source_path, folder, file, saveDoc_mda, prior_titles.get(file.split("_")[0]))
+            else:
+                reused_count += 1
+            if row[-1] == 'success':
+                prior_titles[row[3]] = row[6]
+            mda_rows.append(row)
+            utils.ledger_record('mda', os.path.join(source_path, folder, file), status=row[-1], output=row[1],
+                                sha256=sha256)
+        insert_mda_rows(cur, mda_rows)
+        utils.metadata_commit()
+        utils.ledger_commit()
+        if not config.subfolders_required:
+            break
+    if executor is not None:
+        executor.shutdown()
+    if skipped_count > 0:
+        logger.info(f"Skipped {skipped_count} reports unchanged since their last MD&A extraction")
+    if reused_count > 0:
+        logger.info(f"Reused the MD&A extraction of {reused_count} reports with the same content as another report")
+    if shortcut_tries > 0:
+        logger.info(f"Prior-title shortcut: {shortcut_hits} of {shortcut_tries} reports with a previous match found "
+                    f"the same MD&A title ({shortcut_hits / shortcut_tries:.1%} hit rate)")
+    """Worker processes flush their counters after every report, so the totals cover the whole pool"""
+    total_hits, total_misses = title_cache.totals()
+    cache_hits, cache_misses = total_hits - cache_hits, total_misses - cache_misses
+    if cache_hits + cache_misses > 0:
+        logger.info(f"Title cache: {cache_hits} hits, {cache_misses} misses "
+                    f"({cache_hits / (cache_hits + cache_misses):.1%} hit rate)")
+    record_cache_metrics()
+    cur.close()
+
+
+def extract_mda(source_path, folder, file, saveDoc_mda, prior_title=None):
+    """
+    Finds and extracts the MD&A pages of a single report.
+    :param prior_title: MD&A title last matched for the same ticker. If the outline has it, the fuzzy search is skipped.
+    :return: metadata_mda row as (file, dest_fpath, folder, ticker, outline, mda_extracted, mda_title, status)
+    """
+    import fitz
+    pdfname = os.path.join(source_path, folder, file)
+    outline = 'error'
+    mda_extracted = 'false'
+    mda_title = None
+    dest_fpath = ''
+    with metrics.document('mda', pdfname):
+        try:
+            with metrics.registry.timer('toc_load_seconds', file=file):
                 doc = fitz.open(pdfname)
+                metrics.annotate(pages=doc.page_count)
                 doc_outline = doc.get_toc()
                 doc_outline = [element for element in doc_outline if element[0] == 1]
 
-                if len(doc_outline) == 0:
-                    outline = 'false'
-                    status = 'none'
-                else:
-                    outline = 'true'
-                    mda_match, start_page, end_page = find_mda_range(doc_outline)
-                    if isinstance(mda_match, list):
-                        status = "fail"
-                        mda_title = ''
-                        logger.info(f"{folder} : {file} : None : [Fail]")
-                    elif start_page == -1 or end_page == -1:
-                        status = "no_pageNum"
-                        mda_title = mda_match
-                        logger.info(f"{folder} : {file} : None : [pageNum does not exist]")
+            if len(doc_outline) == 0:
+                outline = 'false'
+                status = 'none'
+            else:
+                outline = 'true'
+                with metrics.registry.timer('match_seconds', file=file):
+                    mda_match = find_prior_title(doc_outline, prior_title) if prior_title else None
+                    if mda_match is not None:
+                        start_page, end_page = find_section_range(mda_match, doc_outline)
                     else:
-                        mda_title = mda_match
-                        source_fpath = os.path.join(source_path, folder, file)
-                        dest_path = os.path.join(saveDoc_mda, folder)
-                        dest_fpath = pdf_extract_range(source_fpath, mda_title, start_page, end_page, dest_path)
-                        mda_extracted = "true"
-                        status = "success"
-                        logger.info(f"{folder} : {file} : {mda_match} : [Success]")
-
-            except Exception as e:
-                logger.debug(traceback.print_exception(*sys.exc_info()))
-                status = "error"
-
-            ticker = file.split("_")[0]
-            query = f'''INSERT INTO metadata_mda VALUES (
-            "{file}", 
-            "{dest_fpath}",                     
-            "{folder}", 
-            "{ticker}", 
-            "{outline}", 
-            "{mda_extracted}", 
-            "{mda_title}", 
-            "{status}")'''
-            try:
-                cur.execute(query)
-            except sqlite3.OperationalError as e:
-                logger.debug(traceback.print_exception(*sys.exc_info()))
-        if not subfolders_required:
-            break
-    cur.close()
-
-
-def find_mda_range(pdf_outline, simple_match=False):
+                        mda_match, start_page, end_page = find_mda_range(doc_outline)
+                if isinstance(mda_match, list):
+                    status = "fail"
+                    mda_title = ''
+                    logger.info(f"{folder} : {file} : None : [Fail]")
+                elif start_page == -1 or end_page == -1:
+                    status = "no_pageNum"
+                    mda_title = mda_match
+                    logger.info(f"{folder} : {file} : None : [pageNum does not exist]")
+                else:
+                    mda_title = mda_match
+                    source_fpath = os.path.join(source_path, folder, file)
+                    dest_path = os.path.join(saveDoc_mda, folder)
+                    with metrics.registry.timer('page_copy_seconds', file=file):
+                        if config.pdf_engine == 'fitz':
+                            dest_fpath = pdf_extract_range_fitz(doc, source_fpath, mda_title, start_page, end_page,
+                                                                dest_path, garbage=config.pdf_garbage,
+                                                                deflate=config.pdf_deflate)
+                        else:
+                            dest_fpath = pdf_extract_range(source_fpath, mda_title, start_page, end_page, dest_path)
+                    mda_extracted = "true"
+                    status = "success"
+                    logger.info(f"{folder} : {file} : {mda_match} : [Success]")
+
+        except Exception as e:
+            logger.debug(traceback.print_exception(*sys.exc_info()))
+            status = "error"
+
+    title_cache.flush()
+    ticker = file.split("_")[0]
+    return file, dest_fpath, folder, ticker, outline, mda_extracted, mda_title, status
+
+
+def reuse_mda(folder, file, saveDoc_mda, original_fpath):
     """
-    Finds the range of MD&A section in a PDF file outline.
-    :param pdf_outline: PDF outline in the format of (lvl(positive int), title(str), page(int)) if simple_match==False,
-    or a flat list of outline titles if simple_match==True.
-    :param simple_match: If True, it simply returns best match of MD&A title from pdf_outline.
-    :return: best match keyword, start page num, end page num
+    Reuses the MD&A extraction of an identical report, such as the same filing under both counters of a dual-counter
+    stock. The MD&A PDF is hardlinked under this report's name.
+    :param original_fpath: path of the identical report, as recorded in the ledger
+    :return: metadata_mda row like extract_mda, or None if the identical report's row or MD&A PDF is gone
     """
-    keywords = ["Management Discussion and Analysis",
+    original_file = os.path.basename(original_fpath)
+    with utils.db_lock:
+        original = config.metadata_db.execute("SELECT file_path, outline, mda_extracted, mda_title_best_match, status "
+                                              "FROM metadata_mda WHERE file_name = ? ORDER BY rowid DESC LIMIT 1",
+                                              (original_file,)).fetchone()
+    if original is None:
+        return None
+    original_dest, outline, mda_extracted, mda_title, status = original
+    dest_fpath = ''
+    if status == 'success':
+        if not os.path.exists(original_dest):
+            return None
+        """The MD&A PDF name starts with the report name, followed by the page range and title"""
+        dest_fpath = os.path.join(saveDoc_mda, folder,
+                                  Path(file).stem + os.path.basename(original_dest)[len(Path(original_file).stem):])
+        if not os.path.exists(dest_fpath):
+            os.makedirs(os.path.dirname(dest_fpath), exist_ok=True)
+            utils.link_file(original_dest, dest_fpath)
+    logger.info(f"{folder} : {file} : {mda_title} : [Same content as {original_file}]")
+    metrics.registry.inc('reused_total', stage='mda')
+    return file, dest_fpath, folder, file.split("_")[0], outline, mda_extracted, mda_title, status
+
+
+def insert_mda_rows(cur, rows):
+    if len(rows) == 0:
+        return
+    query = "INSERT INTO metadata_mda VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    """mda_title is None for reports without an outline, stored as 'None' as before"""
+    params = [(file, dest_fpath, folder, ticker, outline, mda_extracted, str(mda_title), status)
+              for file, dest_fpath, folder, ticker, outline, mda_extracted, mda_title, status in rows]
+    try:
+        with utils.db_lock:
+            cur.executemany(query, params)
+    except sqlite3.OperationalError as e:
+        logger.debug(traceback.print_exception(*sys.exc_info()))
+
+
+MDA_KEYWORDS = ["Management Discussion and Analysis",
                 "管理層討論及分析",
                 "管理層討論與分析",
                 "管理層論述與分析",
@@ -116,74 +241,339 @@ def find_mda_range(pdf_outline, simple_match=False):
                 "管理層之討論及分析"
                 ]
 
-    all_matches = []
-    only_successful_matches = []
+## a matched title is skipped if it is similar to one of below keywords
+SKIP_KEYWORDS = ["consolidated statement", "consolidated income statement", "risk management", "senior management",
+                 "management profile", "management team", "chairman and ceo", "financial statement",
+                 "consolidated cash flow statement", "mission statement", "statement of financial position",
+                 "our mission", "management and administration"]
 
-    if simple_match:
-        for keyword in keywords:
-            mda_match, match_ratio = find_mda_match(keyword, pdf_outline)
-            if not isinstance(mda_match, list):
-                only_successful_matches.append([mda_match, match_ratio, None, None])
-            all_matches.append([mda_match, match_ratio, None, None])
-    else:
-        for keyword in keywords:
-            outline_titles_list = [element[1] for element in pdf_outline]
-            mda_match, match_ratio = find_mda_match(keyword, outline_titles_list)
-            if not isinstance(mda_match, list):
-                start_page, end_page = find_section_range(mda_match, pdf_outline)
-                only_successful_matches.append([mda_match, match_ratio, start_page, end_page])
-            else:
-                start_page = None
-                end_page = None
-            all_matches.append([mda_match, match_ratio, start_page, end_page])
+MATCH_LIMIT = 15  ## number of closest titles considered per keyword
+MIN_MATCH_RATIO = 60
+SKIP_MATCH_RATIO = 80
 
-    if len(only_successful_matches) == 0:
-        return all_matches, None, None
+"""Keyword forms are fixed, so they are preprocessed once instead of for every document"""
+PROCESSED_KEYWORDS = [fuzz_utils.full_process(keyword) for keyword in MDA_KEYWORDS]
+LOWER_KEYWORDS = [keyword.lower() for keyword in MDA_KEYWORDS]
+LOWER_SKIP_KEYWORDS = [keyword.lower() for keyword in SKIP_KEYWORDS]
+ASCII_CHARS = frozenset(map(chr, range(128)))
 
-    df_match_candidates = pd.DataFrame(only_successful_matches,
-                                       columns=['keyword', 'fuzzRatio', 'startPage', 'endPage'])
-    """Find the keyword with the highest fuzzRatio"""
-    df_best_match = df_match_candidates[df_match_candidates['fuzzRatio'] == df_match_candidates['fuzzRatio'].max()]
 
-    if simple_match:
-        return df_best_match['keyword'][0], None, None
+def package_version(distribution):
+    """:return: installed version of a distribution, or None if it is not installed"""
+    try:
+        return importlib.metadata.version(distribution)
+    except importlib.metadata.PackageNotFoundError:
+        return None
 
-    return df_best_match['keyword'][0], df_best_match['startPage'][0], df_best_match['endPage'][0]
 
+@lru_cache(maxsize=None)
+def keywords_version():
+    """
+    Cached title scores are only valid for the keywords, thresholds and scorer they were computed with. thefuzz scores
+    with python-Levenshtein's matcher if installed and difflib's otherwise, and rapidfuzz bounds the scores worth
+    computing, so the versions of all of them are part of the key. Looking them up takes a while, so it is done on
+    first use rather than on import.
+    :return: key of the title_scores records valid for this matcher
+    """
+    scorer = [f"{fuzz.partial_ratio.__module__}.{fuzz.partial_ratio.__name__}", fuzz.SequenceMatcher.__module__,
+              {distribution: package_version(distribution)
+               for distribution in ['thefuzz', 'python-Levenshtein', 'Levenshtein', 'rapidfuzz']}]
+    return hashlib.sha1(json.dumps([MDA_KEYWORDS, SKIP_KEYWORDS, MIN_MATCH_RATIO, SKIP_MATCH_RATIO, scorer],
+                                   ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
 
-def find_mda_match(keyword, titles_list):
-    best_match_list = [element[0] for element in process.extractBests(keyword, titles_list, limit=15, scorer=fuzz.partial_ratio)]
 
-    for match in best_match_list:
-        if isinstance(match, (bytes, bytearray)):
-            b_match = match
-            match = match.decode('utf-8')
-        else:
-            b_match = bytes(match, encoding='utf-8')
+class TitleScoreCache:
+    """
+    Memoizes the score record of each outline title, keyed by the lowercased title. A record holds the match ratio
+    and rank score against every keyword, and whether the title is similar to a skip keyword. The most recently used
+    records are kept in memory, and every record is written to hkex-text-titles.db so that later runs and other
+    worker processes can reuse it.
+    """
+    def __init__(self, db_path=None, max_size=None):
+        """
+        db_path and max_size default to the run configuration, which is read on first use. A db_path of ':memory:'
+        keeps the records of this process only.
+        """
+        self._db_path = db_path
+        self._max_size = max_size
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_pid = None
+        self.unsaved_records = {}
+        self.unsaved_hits = 0
+        self.unsaved_misses = 0
+
+    @property
+    def db_path(self):
+        return self._db_path or os.path.join(config.download_path, 'hkex-text-titles.db')
+
+    @property
+    def max_size(self):
+        return config.title_cache_size if self._max_size is None else self._max_size
+
+    def connect(self):
+        """Opens one connection per process, since a connection inherited from a forked parent can not be shared"""
+        if self.db_pid != os.getpid():
+            self.db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS title_scores 
+                            (keywords_version text, title text, scores text, PRIMARY KEY (keywords_version, title)
+                            )""")
+            self.db.execute("CREATE TABLE IF NOT EXISTS title_cache_stats (name text PRIMARY KEY, value integer)")
+            self.db.commit()
+            self.db_pid = os.getpid()
+            self.unsaved_records = {}
+            self.unsaved_hits = 0
+            self.unsaved_misses = 0
+        return self.db
+
+    def get_scores(self, lower_titles):
+        """
+        :param lower_titles: lowercased outline titles of one document
+        :return: score records in the same order, with only the titles seen nowhere before being scored
+        """
+        if self.max_size == 0:
+            return score_titles(lower_titles)
+        with self.lock:
+            found = {}
+            for title in lower_titles:
+                if title in self.records:
+                    self.records.move_to_end(title)
+                    found[title] = self.records[title]
+            missing = list(dict.fromkeys(title for title in lower_titles if title not in found))
+            unscored = []
+            if missing:
+                db = self.connect()
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    query = (f"SELECT title, scores FROM title_scores WHERE keywords_version = ? "
+                             f"AND title IN ({', '.join('?' * len(batch))})")
+                    for title, scores in db.execute(query, [keywords_version()] + batch):
+                        found[title] = json.loads(scores)
+                unscored = [title for title in missing if title not in found]
+                if unscored:
+                    for title, record in zip(unscored, score_titles(unscored)):
+                        found[title] = record
+                        self.unsaved_records[title] = record
+                for title in missing:
+                    self.records[title] = found[title]
+                while len(self.records) > self.max_size:
+                    self.records.popitem(last=False)
+            """A title is a miss only if it had to be scored, whether it was found in memory or in the database"""
+            self.misses += len(unscored)
+            self.unsaved_misses += len(unscored)
+            self.hits += len(lower_titles) - len(unscored)
+            self.unsaved_hits += len(lower_titles) - len(unscored)
+        return [found[title] for title in lower_titles]
+
+    def get_skipped(self, lower_title, record):
+        """Returns the skip verdict of a score record, computing and saving it on first use"""
+        if record[2] is None:
+            record[2] = is_skipped(lower_title)
+            if self.max_size > 0:
+                with self.lock:
+                    self.unsaved_records[lower_title] = record
+        return record[2]
+
+    def flush(self):
+        """Writes the records scored since the last flush and adds this process's counters to title_cache_stats"""
+        if self.max_size == 0:
+            return
+        with self.lock:
+            if not self.unsaved_records and not self.unsaved_hits and not self.unsaved_misses:
+                return
+            try:
+                db = self.connect()
+                db.executemany("INSERT OR REPLACE INTO title_scores VALUES (?, ?, ?)",
+                               [(keywords_version(), title, json.dumps(record))
+                                for title, record in self.unsaved_records.items()])
+                db.executemany("INSERT INTO title_cache_stats VALUES (?, ?) "
+                               "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                               [('hits', self.unsaved_hits), ('misses', self.unsaved_misses)])
+                db.commit()
+                self.unsaved_records = {}
+                self.unsaved_hits = 0
+                self.unsaved_misses = 0
+            except sqlite3.OperationalError:
+                """A locked database only delays the write until the next flush"""
+                logger.debug(traceback.print_exception(*sys.exc_info()))
+
+    def totals(self):
+        """:return: (hits, misses) summed over every process and run that used hkex-text-titles.db"""
+        if self.max_size == 0:
+            return self.hits, self.misses
+        with self.lock:
+            stats = dict(self.connect().execute("SELECT name, value FROM title_cache_stats").fetchall())
+        return stats.get('hits', 0), stats.get('misses', 0)
+
 
-        """return None if the similarity ratio is below 60 """
-        ratio = fuzz.partial_ratio(match.lower(), keyword.lower())
-        if ratio < 60:
-            continue
+title_cache = TitleScoreCache()
 
-        ## return None if the matched keyword is in below keywords
-        skip_keywords = ["consolidated statement", "consolidated income statement", "risk management", "senior management",
-                         "management profile", "management team", "chairman and ceo", "financial statement",
-                         "consolidated cash flow statement", "mission statement", "statement of financial position",
-                         "our mission", "management and administration"]
 
-        def skip_match(skip_keywords_list):
-            for k in skip_keywords_list:
-                if fuzz.partial_ratio(k.lower(), match.lower()) > 80:
-                    return True
-            return False
+def record_cache_metrics():
+    """Sets the title cache gauges from the totals of every process and run that used hkex-text-titles.db"""
+    hits, misses = title_cache.totals()
+    metrics.registry.set_gauge('title_cache_hits', hits)
+    metrics.registry.set_gauge('title_cache_misses', misses)
+    metrics.registry.set_gauge('title_cache_hit_ratio', hits / (hits + misses) if hits + misses else 0.0)
 
-        if skip_match(skip_keywords):
-            continue
 
-        return match, ratio
+def load_prior_titles():
+    """
+    Collects the MD&A title last matched for every ticker from metadata_mda. Rows are ordered by report month, so the
+    most recent match of a ticker wins.
+    :return: dict of ticker -> mda_title_best_match
+    """
+    with utils.db_lock:
+        rows = config.metadata_db.execute("SELECT ticker, mda_title_best_match FROM metadata_mda "
+                                          "WHERE status = 'success' ORDER BY month, rowid").fetchall()
+    return dict(rows)
+
+
+def normalize_title(title):
+    return ' '.join(title.casefold().split())
+
+
+def find_prior_title(pdf_outline, prior_title):
+    """
+    Looks for a ticker's previous MD&A title in a new outline, ignoring case and whitespace differences.
+    :return: the outline title, or None if the outline does not have it
+    """
+    normalized = normalize_title(prior_title)
+    for element in pdf_outline:
+        if isinstance(element[1], str) and normalize_title(element[1]) == normalized:
+            return element[1]
+    return None
+
+
+def find_mda_range(pdf_outline, simple_match=False, cache=None):
+    """
+    Finds the range of MD&A section in a PDF file outline.
+    :param pdf_outline: PDF outline in the format of (lvl(positive int), title(str), page(int)) if simple_match==False,
+    or a flat list of outline titles if simple_match==True.
+    :param simple_match: If True, it simply returns best match of MD&A title from pdf_outline.
+    :param cache: TitleScoreCache holding the title scores, title_cache if None
+    :return: best match keyword, start page num, end page num
+    """
+    if simple_match:
+        titles_list = pdf_outline
+    else:
+        titles_list = [element[1] for element in pdf_outline]
+
+    all_matches = []
+    best_match = None
+    for mda_match, match_ratio in find_mda_match(titles_list, cache):
+        all_matches.append([mda_match, match_ratio, None, None])
+        """Find the keyword with the highest fuzzRatio, the first one on ties"""
+        if not isinstance(mda_match, list) and (best_match is None or match_ratio > best_match[1]):
+            best_match = [mda_match, match_ratio]
+
+    if best_match is None:
+        return all_matches, None, None
+
+    if simple_match:
+        return best_match[0], None, None
+
+    start_page, end_page = find_section_range(best_match[0], pdf_outline)
+    return best_match[0], start_page, end_page
+
 
-    return best_match_list, None
+def shared_char_pairs(queries, choices):
+    """
+    Lists the choices sharing a character with each query. A pair sharing no character always scores 0, so it is
+    never scored. Chinese keywords are never scored against English-only titles.
+    :return: list of choice indices per query
+    """
+    pairs = []
+    for query in queries:
+        query_chars = set(query)
+        if query.isascii():
+            """Pairs of ASCII strings almost always share a letter, so they skip the character check"""
+            indices = [c for c, choice in enumerate(choices) if choice.isascii() or not query_chars.isdisjoint(choice)]
+        elif query_chars.isdisjoint(ASCII_CHARS):
+            indices = [c for c, choice in enumerate(choices)
+                       if not choice.isascii() and not query_chars.isdisjoint(choice)]
+        else:
+            indices = [c for c, choice in enumerate(choices) if not query_chars.isdisjoint(choice)]
+        pairs.append(indices)
+    return pairs
+
+
+def partial_ratio_matrix(queries, choices, score_cutoff=0):
+    """
+    Bounds thefuzz's partial_ratio of every query (rows) against every choice (columns) from above with rapidfuzz's
+    partial_ratio, which compares every alignment where thefuzz only tries those starting at a matching block. Pairs
+    bounded below a threshold can not reach it, so only the others are scored with thefuzz.
+    :param score_cutoff: bounds below it are returned as 0
+    :return: bounds as a float64 array of shape (len(queries), len(choices))
+    """
+    import numpy as np
+    if len(choices) < len(queries):
+        """partial_ratio is symmetric, so loop over the shorter side"""
+        return partial_ratio_matrix(choices, queries, score_cutoff).T
+    scores = np.zeros((len(queries), len(choices)))
+    for q, (query, indices) in enumerate(zip(queries, shared_char_pairs(queries, choices))):
+        if indices:
+            scores[q, indices] = rf_process.cdist([query], [choices[c] for c in indices], scorer=rf_fuzz.partial_ratio,
+                                                  score_cutoff=score_cutoff, dtype=np.float64)[0]
+    return scores
+
+
+def score_titles(lower_titles):
+    """
+    Scores lowercased outline titles against all keywords with thefuzz's partial_ratio, in the argument order and on
+    the processed forms the matcher has always used.
+    :return: [match_ratios, rank_scores, skipped] per title. match_ratios are used to accept a title, and rank_scores
+    order the closest titles like extractBests. skipped is left as None until is_skipped is needed for the title,
+    since most titles never reach the skip check.
+    """
+    processed_titles = [fuzz_utils.full_process(title) for title in lower_titles]
+    """Bounds below MIN_MATCH_RATIO - 0.5 round below the threshold, so only the titles above are scored"""
+    match_bounds = partial_ratio_matrix(LOWER_KEYWORDS, lower_titles, score_cutoff=MIN_MATCH_RATIO - 0.5)
+    match_ratios = [[0] * len(MDA_KEYWORDS) for _ in lower_titles]
+    rank_scores = [[0] * len(MDA_KEYWORDS) for _ in lower_titles]
+    for k, indices in enumerate(shared_char_pairs(PROCESSED_KEYWORDS, processed_titles)):
+        for i in indices:
+            rank_scores[i][k] = fuzz.partial_ratio(PROCESSED_KEYWORDS[k], processed_titles[i])
+        for i in match_bounds[k].nonzero()[0].tolist():
+            match_ratios[i][k] = fuzz.partial_ratio(lower_titles[i], LOWER_KEYWORDS[k])
+    return [[match, rank, None] for match, rank in zip(match_ratios, rank_scores)]
+
+
+def is_skipped(lower_title):
+    """Bounds below SKIP_MATCH_RATIO + 0.5 can not round above it, so only the skip keywords above are scored"""
+    skip_bounds = partial_ratio_matrix(LOWER_SKIP_KEYWORDS, [lower_title], score_cutoff=SKIP_MATCH_RATIO + 0.5)
+    return any(fuzz.partial_ratio(LOWER_SKIP_KEYWORDS[k], lower_title) > SKIP_MATCH_RATIO
+               for k in skip_bounds[:, 0].nonzero()[0].tolist())
+
+
+def find_mda_match(titles_list, cache=None):
+    """
+    For each keyword, goes through its MATCH_LIMIT closest titles and returns the first one with a ratio of at least
+    MIN_MATCH_RATIO that is not similar to a skip keyword. Title scores come from cache, or title_cache if None.
+    :return: list of (title, ratio) per keyword, or (closest titles, None) if no title matched the keyword
+    """
+    titles_list = [title.decode('utf-8') if isinstance(title, (bytes, bytearray)) else title for title in titles_list]
+    lower_titles = [title.lower() for title in titles_list]
+    cache = title_cache if cache is None else cache
+    records = cache.get_scores(lower_titles)
+
+    matches = []
+    for k in range(len(MDA_KEYWORDS)):
+        """Closest titles in rank order, keeping the outline order on ties"""
+        best_indices = sorted(range(len(records)), key=lambda i: records[i][1][k], reverse=True)[:MATCH_LIMIT]
+        for i in best_indices:
+            match_ratio = records[i][0][k]
+            if match_ratio >= MIN_MATCH_RATIO and not cache.get_skipped(lower_titles[i], records[i]):
+                matches.append((titles_list[i], int(match_ratio)))
+                break
+        else:
+            matches.append(([titles_list[i] for i in best_indices], None))
+    return matches
 
 
 def find_section_range(match, pdf_outline):
@@ -201,37 +591,70 @@ def find_section_range(match, pdf_outline):
     return page_start, page_end
 
 
+def mda_fpath(pdf_fname, outline_title, page_start, page_end, saveDoc_mda):
+    return os.path.join(saveDoc_mda, f'{Path(pdf_fname).stem}_pages_{page_start}-{page_end}_{outline_title.replace(" ", "_")}.pdf')
+
+
 def pdf_extract_range(pdf_fname, outline_title, page_start, page_end, saveDoc_mda):
-    if not os.path.exists(saveDoc_mda):
-        os.mkdir(saveDoc_mda)
+    import PyPDF2
+    os.makedirs(saveDoc_mda, exist_ok=True)
+    dest_fpath = mda_fpath(pdf_fname, outline_title, page_start, page_end, saveDoc_mda)
+    if os.path.exists(dest_fpath):
+        logger.info(f"File already exists. Skipping: {dest_fpath}")
+        return dest_fpath
     with open(pdf_fname, 'rb') as read_stream:
         pdf_reader = PyPDF2.PdfReader(read_stream)
         pdf_writer = PyPDF2.PdfWriter()
         for page_num in range(page_start - 1, page_end):
             pdf_writer.addPage(pdf_reader.getPage(page_num))
 
-        dest_fpath = os.path.join(saveDoc_mda, f'{Path(pdf_fname).stem}_pages_{page_start}-{page_end}_{outline_title.replace(" ", "_")}.pdf')
-        if os.path.exists(dest_fpath):
-            logger.info(f"File already exists. Skipping: {dest_fpath}")
-            return dest_fpath
         with open(dest_fpath, 'wb') as dest_file:
             pdf_writer.write(dest_file)
         return dest_fpath
 
 
+def pdf_extract_range_fitz(doc, pdf_fname, outline_title, page_start, page_end, saveDoc_mda, garbage=0,
+                           deflate=False):
+    """
+    Same as pdf_extract_range, but copies the page range out of the already opened fitz document in one pass instead
+    of re-reading the file with PyPDF2.
+    :param garbage: fitz garbage collection level (0-4) applied when saving.
+    :param deflate: If True, compresses uncompressed streams when saving.
+    """
+    import fitz
+    os.makedirs(saveDoc_mda, exist_ok=True)
+    dest_fpath = mda_fpath(pdf_fname, outline_title, page_start, page_end, saveDoc_mda)
+    if os.path.exists(dest_fpath):
+        logger.info(f"File already exists. Skipping: {dest_fpath}")
+        return dest_fpath
+    if page_start < 1 or page_end > doc.page_count:
+        """fitz silently clamps the range; keep PyPDF2's behaviour of failing on pages that do not exist"""
+        raise IndexError(f"Page range {page_start}-{page_end} is out of bounds for {doc.page_count} pages")
+    mda_doc = fitz.open()
+    mda_doc.insert_pdf(doc, from_page=page_start - 1, to_page=page_end - 1)
+    mda_doc.save(dest_fpath, garbage=garbage, deflate=deflate)
+    mda_doc.close()
+    return dest_fpath
+
+
+@metrics.profiled('mda')
 def main():
     logger.info('Start MD&A extraction')
     script_start_time = time.time()
     utils.init_db_mda()
-    if not os.path.exists(mda_path):
-        os.makedirs(mda_path)
-    get_mda(reports_path, saveDoc_mda=mda_path)
-    metadata_db.commit()
+    utils.migrate_daily_dbs()
+    utils.init_db_ledger()
+    if not os.path.exists(config.mda_path):
+        os.makedirs(config.mda_path)
+    get_mda(config.reports_path, saveDoc_mda=config.mda_path, workers=config.workers)
+    config.metadata_db.commit()
     elapsed_time = time.time() - script_start_time
+    metrics.registry.observe('stage_seconds', elapsed_time, stage='mda')
     logger.info(f"MD&A PDF extraction complete. Elapsed time: {elapsed_time}")
     logger.info('=' * 65)
     return True
 
 
 if __name__ == "__main__":
+    config.load()
     main()
\ No newline at end of file
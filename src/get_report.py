@@ -2,197 +2,544 @@
 This script downloads reports according to the input parameters provided.
 Last updated: July 2022
 """
-import requests
 import json
 import math
 import re
 import os
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import calendar
 import sqlite3
-from bs4 import BeautifulSoup
+import threading
 import traceback
 import sys
-from .utils import module_path, download_path, reports_path, mda_path, metadata_db
-from .utils import module_start_time, stockIdList, t1codeVal, t2codeVal, from_date, to_date
-from .utils import today
+from concurrent.futures import ThreadPoolExecutor
+from .utils import config
 from .utils import logger
-from . import utils, get_mda
+from . import utils, get_mda, metrics
 
+"""One pooled session and one politeness limiter shared by every download thread, created on the first request"""
+session = None
+rate_limiter = None
+session_lock = threading.Lock()
 
-def get_pdf(html_doc, url, filepath):
+BASE_URL = utils.BASE_URL
+SEARCH_URL = f'{BASE_URL}/search/titleSearchServlet.do'
+SEARCH_WINDOW_DAYS = 365  ## to_date may be at most this many days after from_date, as utils.Config enforces
+SEARCH_PAGE_SIZE = 100
+SEARCH_RETRIES = 3  ## attempts per search page before its date range is given up
+SEARCH_RETRY_DELAY = 5  ## seconds, multiplied by the attempt number
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3  ## attempts per filing before its download error is raised
+DOWNLOAD_RETRY_DELAY = 5  ## seconds, multiplied by the attempt number
+search_requests = 0
+search_failures = 0  ## searches given up after SEARCH_RETRIES, each leaving the listing of its range incomplete
+
+
+def init_session(concurrency, rate_limit):
+    """Creates the shared session and limiter from explicit settings, for callers that do not load the configuration"""
+    global session, rate_limiter
+    with session_lock:
+        rate_limiter = utils.RateLimiter(rate_limit)
+        session = utils.new_session(concurrency)
+
+
+def set_base_url(base_url):
+    """Points searches and downloads at another HKEXnews host, such as the fake server of fake_hkex"""
+    global BASE_URL, SEARCH_URL
+    BASE_URL = base_url.rstrip('/')
+    SEARCH_URL = f'{BASE_URL}/search/titleSearchServlet.do'
+
+
+def http_get(url, **kwargs):
+    global session, rate_limiter
+    if session is None:
+        with session_lock:
+            if session is None:
+                rate_limiter = utils.RateLimiter(config.rate_limit)
+                session = utils.new_session(config.concurrency)
+    rate_limiter.wait()
+    return session.get(url, **kwargs)
+
+
+def find_mda_link(html_doc, url, cache=None):
+    """
+    Finds the MD&A section among the links of an HTML report index.
+    :param cache: TitleScoreCache used to match the link texts, get_mda.title_cache if None
+    :return: (section_name, section_url), or None if no link matches
+    """
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html_doc, 'html.parser')
     if 'The page requested may have been relocated, renamed or removed' in soup.text:
-        return
+        return None
     base_url = "/".join(url.split('/')[:-1])
     links_list = soup.find_all('a')
     if len(links_list) == 0:
-        return
+        return None
 
-    mda_match = get_mda.find_mda_range([link.text for link in links_list], simple_match=True)[0]
+    mda_match = get_mda.find_mda_range([link.text for link in links_list], simple_match=True, cache=cache)[0]
 
     for link in links_list:
         if link.get('href') is None:
             continue
-        section_url = f"{base_url}/{link.get('href')}"
-        download = requests.get(section_url)
-        section_name = link.text
-        if not section_name == mda_match:
-            continue
-        if "/" in section_name:
-            section_name = re.sub('/', '', section_name)
+        if link.text == mda_match:
+            return link.text, f"{base_url}/{link.get('href')}"
+    return None
 
-        with open(f"{filepath.replace('.txt', '')}_pages_n-n_{section_name.replace(' ', '')}.pdf", 'wb') as f:
-            f.write(download.content)
-            return
 
+def get_pdf(html_doc, url, filepath):
+    """
+    Downloads the MD&A section PDF linked from an HTML report index.
+    :return: path of the MD&A PDF written, or None if no link matches
+    """
+    mda_link = find_mda_link(html_doc, url)
+    if mda_link is None:
+        return None
+    section_name, section_url = mda_link
+    download = http_get(section_url)
+    if "/" in section_name:
+        section_name = re.sub('/', '', section_name)
 
-def download_report(fromDateVal, toDateVal, saveDoc, saveDoc_mda, stockId):
-    cur = metadata_db.cursor()
-    params = {'sortDir': 0, 'sortByOptions': 'DateTime', 'category': 0, 'market': 'SEHK', 'stockId': stockId, 'documentType': -1,
-              't1code': t1codeVal, 't2Gcode': -2, 't2code': t2codeVal, 'searchType': 0, 'title': '', 'lang': 'E',
-              'rowRange': 100, 'fromDate': fromDateVal, 'toDate': toDateVal}
+    mda_fpath = f"{filepath.replace('.txt', '')}_pages_n-n_{section_name.replace(' ', '')}.pdf"
+    with open(mda_fpath, 'wb') as f:
+        f.write(download.content)
+    return mda_fpath
 
-    r_getCnt = requests.get('https://www1.hkexnews.hk/search/titleSearchServlet.do', params=params)
-    try:
-        totalCnt = json.loads(r_getCnt.text)['recordCnt']
-    except json.decoder.JSONDecodeError as e:
-        logger.debug(traceback.print_exception(*sys.exc_info()))
-        return
-    logger.info(f"Total Record return: {totalCnt}")
-    params['rowRange'] = int(math.ceil(totalCnt / 100.0)) * 100
-    r_getRow = requests.get('https://www1.hkexnews.hk/search/titleSearchServlet.do', params=params)
-    try:
-        data = json.loads(r_getRow.text)
-    except json.decoder.JSONDecodeError as e:
-        logger.debug(traceback.print_exception(*sys.exc_info()))
-        return
-    logger.info(f"Still have next row: {data['hasNextRow']}")
-    logger.info(f"Loaded Record: {data['loadedRecord']}")
-    logger.info(f"Total Record: {data['recordCnt']}")
-    rptList = json.loads(data['result'])
+
+def fetch_report(file_link, filetype, filename, filepath, mdapath):
+    """
+    Streams a single filing into the blob store and links it at filepath. Runs in a download thread.
+    :return: (SHA-256 of the filing, path of the MD&A PDF saved for an HTML annual report or None)
+    """
+    import requests
+    base_url = BASE_URL + file_link
+    with metrics.document('download', filepath):
+        with metrics.registry.timer('download_seconds', file=filename):
+            for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                try:
+                    with http_get(base_url, stream=True) as download:
+                        """Error pages are not stored as reports"""
+                        download.raise_for_status()
+                        sha256 = utils.store_blob(download.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE), filepath,
+                                                  f'.{filetype}')
+                    break
+                except requests.exceptions.RequestException as e:
+                    logger.warning(f"Download {file_link} failed ({attempt}/{DOWNLOAD_RETRIES}): {e}")
+                    metrics.registry.inc('download_retries_total')
+                    if attempt == DOWNLOAD_RETRIES:
+                        raise
+                    time.sleep(DOWNLOAD_RETRY_DELAY * attempt)
+        metrics.registry.inc('download_bytes_total', os.path.getsize(filepath))
+        mda_fpath = None
+        if (filetype.lower() in ['htm', 'txt']) and ('annual' in filename.lower()):
+            with open(filepath, 'rb') as f:
+                mda_fpath = get_pdf(f.read(), base_url, mdapath)
+    return sha256, mda_fpath
+
+
+def download_report(rptList, saveDoc, saveDoc_mda, executor, on_report=None):
+    """
+    Downloads the given filings on the executor's threads. Logging and metadata inserts still happen here, in the
+    original row order.
+    :param rptList: filings as yielded by search_pages
+    :param on_report: Optional callback receiving the path of every saved (or already existing) report, and of the
+    MD&A PDF saved for an HTML annual report.
+    """
+    record_reports(submit_reports(rptList, saveDoc, saveDoc_mda, executor), saveDoc, on_report)
+
+
+def submit_reports(rptList, saveDoc, saveDoc_mda, executor):
+    """:return: pending list of (future, idx, row, filename, filepath). future is None for existing files."""
+    pending = []
     for idx, row in enumerate(rptList):
-        filetype = 'txt'
-        if len(row['FILE_TYPE']):
-            filetype = row['FILE_TYPE'].lower()
-        stock_code_clean = re.sub(r'<.*?>', '.', row['STOCK_CODE'][:20])
-        report_date = datetime.strftime(datetime.strptime(row['DATE_TIME'], '%d/%m/%Y %H:%M'), '%Y%m%d')
-        title_clean = (row['TITLE'][:100] + '...' if len(row['TITLE']) > 100 else row['TITLE']).replace(' ', '-')
-        filename = f"{stock_code_clean}_{row['NEWS_ID']}_{report_date}_{title_clean}.{filetype}"
-        filename = re.sub(r'[\\/*?:"<>|]', "", filename)
+        filename, filetype = report_filename(row)
         filepath = os.path.join(saveDoc, filename)
         if os.path.exists(filepath):
-            logger.info(f"File already exists. Skipping: {filepath}")
+            pending.append((None, idx, row, filename, filepath))
             continue
         mdapath = os.path.join(saveDoc_mda, filename)
 
-        base_url = 'https://www1.hkexnews.hk' + row['FILE_LINK']
-        download = requests.get(base_url)
-        if (filetype.lower() in ['htm', 'txt']) and ('annual' in filename.lower()):
-            get_pdf(download.content, base_url, mdapath)
-
-        with open(filepath, 'wb') as f:
-            f.write(download.content)
-            logger.info(f"{idx} : "
-                        f"{re.sub(r'<.*?>', ',', row['STOCK_CODE'])} : "
-                        f"{re.sub(r'<.*?>', ',', row['STOCK_NAME'])} : "
-                        f"{row['TITLE']} : "
-                        f"{filename} : "
-                        f"[Downloaded]")
-
-        query = f'''INSERT INTO metadata VALUES (
-                "{row['FILE_INFO']}",
-                "{filename}",
-                "{filepath}", 
-                "{os.path.split(saveDoc)[1]}",
-                "{row['DATE_TIME']}", 
-                "{row['STOCK_CODE']}", 
-                "{row['STOCK_NAME']}", 
-                "{re.sub('"', "'", row['TITLE'])}", 
-                "{row['NEWS_ID']}", 
-                "{row['SHORT_TEXT']}", 
-                "{row['LONG_TEXT']}", 
-                "{row['TOTAL_COUNT']}", 
-                "{row['FILE_TYPE']}", 
-                "{row['FILE_LINK']}", 
-                "{row['DOD_WEB_PATH']}")'''
-        try:
-            cur.execute(query)
-        except sqlite3.OperationalError as e:
-            traceback.print_exception(*sys.exc_info())
+        future = executor.submit(fetch_report, row['FILE_LINK'], filetype, filename, filepath, mdapath)
+        pending.append((future, idx, row, filename, filepath))
+    return pending
+
+
+def record_reports(pending, saveDoc, on_report=None):
+    """
+    Waits for the downloads of submit_reports and inserts their metadata rows. A filing whose download failed is
+    logged and left out, without its file, so that the next run downloads it again. The other filings are recorded.
+    """
+    cur = config.metadata_db.cursor()
+    records = []
+    for future, idx, row, filename, filepath in pending:
+        if future is None:
+            logger.info(f"File already exists. Skipping: {filepath}")
+            metrics.registry.inc('files_total', stage='download', status='exists')
+        else:
+            try:
+                sha256, mda_fpath = future.result()
+            except Exception as e:
+                logger.error(f"{idx} : {filename} : [Download failed] {e!r}")
+                logger.debug(traceback.format_exc())
+                metrics.registry.inc('files_total', stage='download', status='fail')
+                """The report may already be linked at filepath if the MD&A section of an HTML report failed"""
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                continue
+            records.append(record_report(idx, row, filename, filepath, saveDoc, sha256))
+            metrics.registry.inc('files_total', stage='download', status='downloaded')
+            if on_report is not None and mda_fpath is not None:
+                on_report(mda_fpath)
+        if on_report is not None:
+            on_report(filepath)
+    insert_report_rows(cur, records)
+    utils.metadata_commit()
     cur.close()
 
 
-def main():
-    logger.info('Start report download')
-    script_start_time = time.time()
-    utils.init_db()
+def download_pages(pages, executor, on_report=None):
+    """
+    Downloads filings page by page as the search yields them. The downloads of a page run while the next page is
+    searched, and are recorded right after.
+    :param pages: iterable of filing lists, as yielded by search_pages
+    """
+    previous = []
+    try:
+        for rptList in pages:
+            submitted = [(saveDoc, submit_reports(rows, saveDoc, saveDoc_mda, executor))
+                         for saveDoc, saveDoc_mda, rows in report_folders(rptList)]
+            for saveDoc, pending in previous:
+                record_reports(pending, saveDoc, on_report)
+            previous = submitted
+    finally:
+        """The downloads of the last page are recorded even if the search of the next one failed"""
+        for saveDoc, pending in previous:
+            record_reports(pending, saveDoc, on_report)
+
+
+def report_folders(rptList):
+    """
+    Monthly and yearly ranges are searched in wide windows and saved in yyyy_mm folders.
+    :return: list of (saveDoc, saveDoc_mda, filings), with the folders created
+    """
+    if not config.subfolders_required:
+        return [(config.reports_path, config.mda_path, rptList)]
+    folders = []
+    for month_folder, month_rows in shard_reports(rptList):
+        saveDoc = os.path.join(config.reports_path, month_folder)
+        saveDoc_mda = os.path.join(config.mda_path, month_folder)
+        if not os.path.exists(saveDoc):
+            os.makedirs(saveDoc)
+        if not os.path.exists(saveDoc_mda):
+            os.makedirs(saveDoc_mda)
+        folders.append((saveDoc, saveDoc_mda, month_rows))
+    return folders
+
+
+def search_page(fromDateVal, toDateVal, stockId, t1code, t2code, rowRange):
+    """
+    Requests one page of search results, retrying on its own if the request or its JSON fails.
+    :return: parsed response with recordCnt, hasNextRow, loadedRecord and result, or None after SEARCH_RETRIES
+    """
+    import requests
+    global search_requests
+    params = {'sortDir': 0, 'sortByOptions': 'DateTime', 'category': 0, 'market': 'SEHK', 'stockId': stockId, 'documentType': -1,
+              't1code': t1code, 't2Gcode': -2, 't2code': t2code, 'searchType': 0, 'title': '',
+              'lang': 'E',
+              'rowRange': rowRange, 'fromDate': fromDateVal, 'toDate': toDateVal}
+    for attempt in range(1, SEARCH_RETRIES + 1):
+        search_requests += 1
+        metrics.registry.inc('search_requests_total')
+        try:
+            with metrics.registry.timer('search_seconds'):
+                r_getRow = http_get(SEARCH_URL, params=params)
+                r_getRow.raise_for_status()
+                return json.loads(r_getRow.text)
+        except (requests.exceptions.RequestException, json.decoder.JSONDecodeError) as e:
+            logger.warning(f"Search {fromDateVal}-{toDateVal} stockId {stockId} rowRange {rowRange} failed "
+                           f"({attempt}/{SEARCH_RETRIES}): {e}")
+            logger.debug(traceback.print_exception(*sys.exc_info()))
+            if attempt < SEARCH_RETRIES:
+                time.sleep(SEARCH_RETRY_DELAY * attempt)
+    logger.error(f"Search {fromDateVal}-{toDateVal} stockId {stockId} gave up after {SEARCH_RETRIES} attempts")
+    return None
+
+
+class SearchError(Exception):
+    """Raised by search_pages when a page fails all its retries, so that the older filings of its range are not listed"""
+
+
+def search_pages(fromDateVal, toDateVal, stockId, t1code, t2code):
+    """
+    Pages through the filings of one stock, or of all stocks if stockId is -1, in the given date range. The search has
+    no offset parameter and lists the newest filings first, so the cursor is the date of the oldest filing seen: the
+    next page searches up to that date again, and filings already yielded are dropped by NEWS_ID. A date with more
+    than a page of filings is fetched on its own, with rowRange set to its count. If a page fails all its retries,
+    SearchError is raised after the pages before it, since the rest of the range can not be listed.
+    :return: generator of filing lists, one per page, without duplicates
+    """
+    seen = set()
+    cursor = toDateVal
+    while True:
+        data = search_page(fromDateVal, cursor, stockId, t1code, t2code, SEARCH_PAGE_SIZE)
+        if data is None:
+            raise search_failed(fromDateVal, cursor, stockId)
+        if cursor == toDateVal:
+            logger.info(f"Total Record return: {data['recordCnt']}")
+        rptList = json.loads(data['result'])
+        next_cursor = report_date(rptList[-1]) if data['hasNextRow'] and len(rptList) > 0 else None
+        if next_cursor == cursor:
+            """The page holds nothing but the cursor date, so that date is loaded in full, and the cursor moves on"""
+            rowRange = int(math.ceil(data['recordCnt'] / SEARCH_PAGE_SIZE)) * SEARCH_PAGE_SIZE
+            data = search_page(cursor, cursor, stockId, t1code, t2code, rowRange)
+            if data is None:
+                raise search_failed(fromDateVal, cursor, stockId)
+            rptList = json.loads(data['result'])
+            next_cursor = (datetime.strptime(cursor, '%Y%m%d') - timedelta(days=1)).strftime('%Y%m%d')
+            if next_cursor < fromDateVal:
+                next_cursor = None
+
+        new_rows = [row for row in rptList if row['NEWS_ID'] not in seen]
+        seen.update(row['NEWS_ID'] for row in new_rows)
+        logger.info(f"Loaded Record: {data['loadedRecord']}, new: {len(new_rows)}, "
+                    f"still have next row: {next_cursor is not None}")
+        if len(new_rows) > 0:
+            yield new_rows
+        if next_cursor is None:
+            return
+        cursor = next_cursor
+
+
+def search_failed(fromDateVal, cursor, stockId):
+    """
+    Counts a search given up by search_pages.
+    :return: SearchError to raise
+    """
+    global search_failures
+    search_failures += 1
+    metrics.registry.inc('search_failures_total')
+    return SearchError(f"Search {fromDateVal}-{cursor} stockId {stockId} failed, so the filings from {fromDateVal} to "
+                       f"{cursor} are not all listed")
+
+
+def report_date(row):
+    """:return: 'yyyymmdd' date of a filing, from its DATE_TIME"""
+    return datetime.strftime(datetime.strptime(row['DATE_TIME'], '%d/%m/%Y %H:%M'), '%Y%m%d')
+
+
+def report_key(row):
+    """:return: ('yyyymmddHHMM', NEWS_ID) of a filing, ordered like the search lists filings (newest last)"""
+    return (datetime.strftime(datetime.strptime(row['DATE_TIME'], '%d/%m/%Y %H:%M'), '%Y%m%d%H%M'),
+            int(row['NEWS_ID']))
+
+
+def report_news_id(fpath):
+    """:return: NEWS_ID of a report, or of an MD&A PDF or text file extracted from it, parsed from its file name"""
+    return int(os.path.basename(fpath).split('_')[1])
+
+
+def next_watermark(watermark, keys, failed):
+    """
+    Advances a watermark over the new filings of a tail pass, but not past a filing that failed, so that the next pass
+    searches it again. The filings after it that did not fail are skipped then as they already exist.
+    :param keys: report_key of each new filing
+    :param failed: report_key of the new filings that failed
+    :return: newest key older than every failed one, or watermark if there is none
+    """
+    oldest_failed = min(failed, default=None)
+    done = [key for key in keys if oldest_failed is None or key < oldest_failed]
+    return max(done + ([watermark] if watermark is not None else []), default=None)
+
+
+def report_month(row):
+    """:return: 'yyyy_mm' subfolder of a filing, from its DATE_TIME"""
+    return datetime.strftime(datetime.strptime(row['DATE_TIME'], '%d/%m/%Y %H:%M'), '%Y_%m')
+
+
+def shard_reports(rptList):
+    """
+    Groups filings by report_month, keeping the row order within each month.
+    :return: list of (month_folder, filings) in the order the months first appear
+    """
+    months = {}
+    for row in rptList:
+        months.setdefault(report_month(row), []).append(row)
+    return list(months.items())
+
+
+def report_filename(row):
+    """:return: (filename, filetype) a filing is saved under"""
+    filetype = 'txt'
+    if len(row['FILE_TYPE']):
+        filetype = row['FILE_TYPE'].lower()
+    stock_code_clean = re.sub(r'<.*?>', '.', row['STOCK_CODE'][:20])
+    title_clean = (row['TITLE'][:100] + '...' if len(row['TITLE']) > 100 else row['TITLE']).replace(' ', '-')
+    filename = f"{stock_code_clean}_{row['NEWS_ID']}_{report_date(row)}_{title_clean}.{filetype}"
+    filename = re.sub(r'[\\/*?:"<>|]', "", filename)
+    return filename, filetype
+
+
+def record_report(idx, row, filename, filepath, saveDoc, sha256):
+    """Logs a downloaded report and returns its metadata row"""
+    logger.info(f"{idx} : "
+                f"{re.sub(r'<.*?>', ',', row['STOCK_CODE'])} : "
+                f"{re.sub(r'<.*?>', ',', row['STOCK_NAME'])} : "
+                f"{row['TITLE']} : "
+                f"{filename} : "
+                f"[Downloaded]")
+    return (row['FILE_INFO'], filename, filepath, os.path.split(saveDoc)[1], row['DATE_TIME'], row['STOCK_CODE'],
+            row['STOCK_NAME'], row['TITLE'], row['NEWS_ID'], row['SHORT_TEXT'], row['LONG_TEXT'], row['TOTAL_COUNT'],
+            row['FILE_TYPE'], row['FILE_LINK'], row['DOD_WEB_PATH'], sha256)
+
+
+def insert_report_rows(cur, rows):
+    if len(rows) == 0:
+        return
+    query = "INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    try:
+        with utils.db_lock:
+            cur.executemany(query, rows)
+    except sqlite3.OperationalError as e:
+        logger.debug(traceback.print_exception(*sys.exc_info()))
+
+
+def search_windows(from_date, to_date):
+    """
+    Covers the requested dates with as few search ranges as the search allows.
+    :param from_date: yyyymmdd, yyyymm or yyyy, like --from_date. yyyymm and yyyy cover whole months and years.
+    :param to_date: same format as from_date
+    :return: list of (fromDateVal, toDateVal), each spanning at most SEARCH_WINDOW_DAYS days
+    """
     if len(from_date) == 8 and len(to_date) == 8:
         """Parsing dates (yyyymmdd)"""
-        if not os.path.exists(reports_path):
-            os.makedirs(reports_path)
-        if not os.path.exists(mda_path):
-            os.makedirs(mda_path)
-        logger.info(f"Downloading from {from_date} to {to_date}")
-        for stockId in stockIdList:
-            download_report(from_date, to_date, saveDoc=reports_path, saveDoc_mda=mda_path, stockId=stockId)
+        start_date = datetime.strptime(from_date, '%Y%m%d')
+        end_date = datetime.strptime(to_date, '%Y%m%d')
     elif len(from_date) == 6 and len(to_date) == 6:
         """Parsing months (yyyymm)"""
-        from_year = int(from_date[:4])
-        to_year = int(to_date[:4])
-        from_month = int(from_date[4:6])
-        to_month = int(to_date[4:6])
-        for year in range(from_year, to_year + 1):
-            for month in range(1, 12 + 1):
-                if year == from_year:
-                    if month < from_month:
-                        continue
-                if year == to_year:
-                    if month > to_month:
-                        continue
-                month_end_date = calendar.monthrange(year, month)[1]
-                month = str(month).zfill(2)
-                logger.info(f"Downloading y {year}, m {month}")
-                saveDoc = os.path.join(reports_path, f'{year}_{month}')
-                saveDoc_mda = os.path.join(mda_path, f'{year}_{month}')
-                if not os.path.exists(saveDoc):
-                    os.makedirs(saveDoc)
-                if not os.path.exists(saveDoc_mda):
-                    os.makedirs(saveDoc_mda)
-                fromDateVal = f'{year}{month}01'
-                toDateVal = f'{year}{month}{month_end_date}'
-                for stockId in stockIdList:
-                    download_report(fromDateVal, toDateVal, saveDoc=saveDoc, saveDoc_mda=saveDoc_mda, stockId=stockId)
+        start_date = datetime.strptime(from_date, '%Y%m')
+        end_date = datetime.strptime(to_date, '%Y%m')
+        end_date = end_date.replace(day=calendar.monthrange(end_date.year, end_date.month)[1])
     elif len(from_date) == 4 and len(to_date) == 4:
         """Parsing years (yyyy)"""
-        from_year = int(from_date[:4])
-        to_year = int(to_date[:4])
-        for year in range(from_year, to_year+1):
-            for month in range(1, 12+1):
-                month_end_date = calendar.monthrange(year, month)[1]
-                month = str(month).zfill(2)
-                logger.info(f"Downloading y {year}, m {month}")
-                saveDoc = os.path.join(reports_path, f'{year}_{month}')
-                saveDoc_mda = os.path.join(mda_path, f'{year}_{month}')
-                if not os.path.exists(saveDoc):
-                    os.makedirs(saveDoc)
-                if not os.path.exists(saveDoc_mda):
-                    os.makedirs(saveDoc_mda)
-                fromDateVal = f'{year}{month}01'
-                toDateVal = f'{year}{month}{month_end_date}'
-                for stockId in stockIdList:
-                    download_report(fromDateVal, toDateVal, saveDoc=saveDoc, saveDoc_mda=saveDoc_mda, stockId=stockId)
+        start_date = datetime(int(from_date), 1, 1)
+        end_date = datetime(int(to_date), 12, 31)
     else:
         raise Exception("--from_date and --to_date not in length of 8, 6, or 4. Please revise your entry. For help, "
                         "refer to the argument help description.")
-    metadata_db.commit()
+
+    windows = []
+    while start_date <= end_date:
+        window_end = min(start_date + timedelta(days=SEARCH_WINDOW_DAYS), end_date)
+        windows.append((start_date.strftime('%Y%m%d'), window_end.strftime('%Y%m%d')))
+        start_date = window_end + timedelta(days=1)
+    return windows
+
+
+def tail_reports(executor, on_report=None, on_watermark=None):
+    """
+    Downloads the filings published after the watermark of the report type and each stock. The search starts on the
+    watermark's day, or on --from_date if no watermark is stored yet (today if neither is), and runs up to today.
+    Filings up to the watermark are dropped, so only newer ones are downloaded. A filing whose download failed holds
+    the watermark back, see next_watermark. A search that failed holds it where it is, since filings older than the
+    failed page may be missing however new the ones listed are.
+    :param on_watermark: Optional callback receiving (stockId, watermark, keys, failed, search_failed) once a stock's
+    new filings are downloaded, with the report_key of the new filings and of those that failed to download, and
+    whether a search failed. The watermark is advanced right away if None.
+    :return: number of new filings
+    """
+    today = datetime.now().strftime('%Y%m%d')
+    new_count = 0
+    for stockId in config.stockIdList:
+        watermark = utils.load_watermark(config.t2codeVal, stockId)
+        if watermark is not None:
+            fromDate = watermark[0][:8]
+        elif config.from_date is not None:
+            fromDate = search_windows(config.from_date, config.from_date)[0][0]
+        else:
+            fromDate = today
+        keys, reported = {}, set()
+        search_failed = False
+
+        def new_pages(pages):
+            nonlocal new_count
+            for rptList in pages:
+                new_rows = [row for row in rptList if watermark is None or report_key(row) > watermark]
+                if len(new_rows) == 0:
+                    continue
+                keys.update({int(row['NEWS_ID']): report_key(row) for row in new_rows})
+                new_count += len(new_rows)
+                yield new_rows
+
+        def report(fpath):
+            """record_reports reports every filing but those whose download failed"""
+            reported.add(report_news_id(fpath))
+            if on_report is not None:
+                on_report(fpath)
+
+        for fromDateVal, toDateVal in search_windows(min(fromDate, today), today):
+            logger.info(f"Tailing stockId {stockId} from {fromDateVal} to {toDateVal}, watermark {watermark}")
+            try:
+                download_pages(new_pages(search_pages(fromDateVal, toDateVal, stockId, config.t1codeVal,
+                                                      config.t2codeVal)), executor, on_report=report)
+            except SearchError as e:
+                """The newer search windows are still downloaded"""
+                logger.error(f"[Search failed] {e}. The watermark of stockId {stockId} is held")
+                search_failed = True
+        failed = {key for news_id, key in keys.items() if news_id not in reported}
+        if on_watermark is not None:
+            on_watermark(stockId, watermark, list(keys.values()), failed, search_failed)
+        elif not search_failed:
+            newest = next_watermark(watermark, keys.values(), failed)
+            if newest is not None and newest != watermark:
+                utils.save_watermark(config.t2codeVal, stockId, newest)
+    logger.info(f"New filings since the watermarks: {new_count}")
+    return new_count
+
+
+@metrics.profiled('download')
+def main(on_report=None, on_watermark=None):
+    """
+    :param on_report: passed on to download_pages
+    :param on_watermark: passed on to tail_reports in tail mode
+    """
+    logger.info('Start report download')
+    script_start_time = time.time()
+    set_base_url(config.base_url)
+    utils.init_db()
+    utils.migrate_daily_dbs()
+    executor = ThreadPoolExecutor(max_workers=config.concurrency)
+    if not os.path.exists(config.reports_path):
+        os.makedirs(config.reports_path)
+    if not os.path.exists(config.mda_path):
+        os.makedirs(config.mda_path)
+    if config.tail_mode:
+        utils.init_db_watermarks()
+        tail_reports(executor, on_report=on_report, on_watermark=on_watermark)
+    else:
+        for fromDateVal, toDateVal in search_windows(config.from_date, config.to_date):
+            logger.info(f"Downloading from {fromDateVal} to {toDateVal}")
+            for stockId in config.stockIdList:
+                try:
+                    download_pages(search_pages(fromDateVal, toDateVal, stockId, config.t1codeVal, config.t2codeVal),
+                                   executor, on_report=on_report)
+                except SearchError as e:
+                    """The other ranges and stocks are still downloaded, and the run ends with exit status 1"""
+                    logger.error(f"[Search failed] {e}")
+    executor.shutdown()
+    get_mda.title_cache.flush()
+    with utils.db_lock:
+        config.metadata_db.commit()
     elapsed_time = time.time() - script_start_time
-    logger.info(f"Download complete. Elapsed time: {elapsed_time}")
+    metrics.registry.observe('stage_seconds', elapsed_time, stage='download')
+    logger.info(f"Download complete. Search requests: {search_requests}. Elapsed time: {elapsed_time}")
+    if search_failures > 0:
+        logger.error(f"{search_failures} searches failed, so reports are missing. Rerun the same dates to fetch them")
     logger.info('=' * 65)
     return True
 
 
 if __name__ == "__main__":
+    config.load()
     main()
+    sys.exit(1 if search_failures > 0 else 0)
 
@@ -0,0 +1,159 @@
+"""
+This script load tests report download offline. It starts the fake HKEXnews server of fake_hkex with the given
+latency, error rate and throttling, points get_report at it with --base_url, and downloads every filing it lists once
+per concurrency level. Reported are the throughput, the latency percentiles of searches and report downloads
+(including retries), and whether every report was saved with the content the server sent.
+Usage: python -m hkex-text-mda.src.load_test [--concurrency 1,2,4,8] [--latency MS] [--error_rate P] [--copies N]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import threading
+from datetime import datetime
+from . import fake_hkex
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load tests report download against a local fake HKEXnews server.")
+    parser.add_argument("--concurrency", "-c", required=False, default='1,2,4,8',
+                        help="Download thread counts to run, separated by commas. Default: 1,2,4,8")
+    parser.add_argument("--rate_limit", "-rl", required=False, type=float, default=0,
+                        help="--rate_limit of the downloader, in requests per second. Default: 0 (none)")
+    parser.add_argument("--stock_codes", "-sc", action="store_true",
+                        help="Resolves the stock code of every listed filing and searches per stock, instead of "
+                             "searching all stocks at once.")
+    parser.add_argument("--retry_delay", "-rd", required=False, type=float, default=0.1,
+                        help="Seconds between search and download retries, multiplied by the attempt number, in place "
+                             "of the 5s used against HKEX. Default: 0.1")
+    parser.add_argument("--samples_path", "-s", required=False, default=fake_hkex.default_samples_path,
+                        help="Directory holding an 'hkex_reports' folder of sample reports. Default: ./reports_data")
+    parser.add_argument("--copies", "-cp", required=False, type=int, default=10,
+                        help="Number of times the samples are listed by the server. Default: 10")
+    parser.add_argument("--latency", "-l", required=False, type=float, default=50,
+                        help="Milliseconds the server adds to every response. Default: 50")
+    parser.add_argument("--jitter", "-j", required=False, type=float, default=50,
+                        help="Up to this many more milliseconds per response. Default: 50")
+    parser.add_argument("--slow_rate", "-sr", required=False, type=float, default=0.02,
+                        help="Share of responses delayed by --slow_latency on top. Default: 0.02")
+    parser.add_argument("--slow_latency", "-sl", required=False, type=float, default=1000,
+                        help="Milliseconds added to slow responses. Default: 1000")
+    parser.add_argument("--error_rate", "-er", required=False, type=float, default=0.05,
+                        help="Share of requests the server answers with 500. Default: 0.05")
+    parser.add_argument("--throttle", "-th", required=False, type=float, default=0,
+                        help="Requests per second the server allows before answering 429. Default: 0 (none)")
+    parser.add_argument("--seed", required=False, type=int, default=0, help="Seed of the server's draws. Default: 0")
+    return parser.parse_args()
+
+
+def percentile(values, share):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+class Timings:
+    """Wraps a function to record the duration of each call, from any thread"""
+    def __init__(self, func):
+        self.func = func
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.durations.append(time.perf_counter() - start_time)
+
+
+def run_download(base_url, concurrency, bench_args, rows, hashes):
+    """
+    Downloads every filing the server lists into a new directory.
+    :return: dict of the measurements of the run
+    """
+    from . import utils, get_report
+    dates = sorted(datetime.strptime(row['DATE_TIME'], '%d/%m/%Y %H:%M') for row in rows)
+    with tempfile.TemporaryDirectory() as tmp_path:
+        argv = ['-t2', '40100', '-fd', f"{dates[0]:%Y%m%d}", '-td', f"{dates[-1]:%Y%m%d}", '-dp', tmp_path,
+                '-bu', base_url, '-c', str(concurrency), '-rl', str(bench_args.rate_limit), '-sit', '0']
+        expected = list(hashes)
+        if bench_args.stock_codes:
+            codes = sorted(fake_hkex.stock_ids(rows))
+            argv += ['-sc', ','.join(codes)]
+            """Filings without a stock code are only listed when searching all stocks"""
+            expected = [row['FILE_LINK'] for row in rows if row['STOCK_CODE']]
+        """The harness prints its own summary, so the console only shows errors. The log file keeps everything"""
+        with contextlib.redirect_stderr(io.StringIO()):
+            utils.config.load(argv)
+        for handler in utils.logger.handlers:
+            if handler.get_name() == 'my_console_handler':
+                handler.setStream(sys.stderr)
+                handler.setLevel('ERROR')
+        get_report.init_session(concurrency, bench_args.rate_limit)
+        get_report.search_requests = 0
+        get_report.SEARCH_RETRY_DELAY = get_report.DOWNLOAD_RETRY_DELAY = bench_args.retry_delay
+        fetch_report, search_page = get_report.fetch_report, get_report.search_page
+        get_report.fetch_report, get_report.search_page = Timings(fetch_report), Timings(search_page)
+        error = None
+        start_time = time.perf_counter()
+        try:
+            get_report.main()
+        except Exception as e:
+            error = e
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            downloads, searches = get_report.fetch_report.durations, get_report.search_page.durations
+            get_report.fetch_report, get_report.search_page = fetch_report, search_page
+        saved = dict(utils.config.metadata_db.execute("SELECT file_link, sha256 FROM metadata").fetchall())
+        utils.config.metadata_db.close()
+        utils.config.state_db.close()
+        get_report.set_base_url(utils.BASE_URL)
+    return {'concurrency': concurrency, 'elapsed': elapsed_time, 'reports': len(saved), 'searches': len(searches),
+            'missing': len([file_link for file_link in expected if file_link not in saved]),
+            'corrupt': len([file_link for file_link, sha256 in saved.items() if hashes.get(file_link) != sha256]),
+            'download_p50': percentile(downloads, 0.5), 'download_p95': percentile(downloads, 0.95),
+            'download_p99': percentile(downloads, 0.99), 'download_max': max(downloads, default=0.0),
+            'search_p50': percentile(searches, 0.5), 'search_p95': percentile(searches, 0.95),
+            'error': error}
+
+
+def main():
+    bench_args = parse_args()
+    rows, files = fake_hkex.sample_catalogue(bench_args.samples_path, bench_args.copies)
+    hashes = fake_hkex.file_hashes(files)
+    size_mb = sum(os.path.getsize(fpath) for fpath in files.values()) / 1024 / 1024
+    print(f"{len(rows)} filings, {size_mb:.1f}MB, latency {bench_args.latency}+{bench_args.jitter}ms, "
+          f"{bench_args.slow_rate:.0%} slow by {bench_args.slow_latency}ms, {bench_args.error_rate:.0%} errors, "
+          f"throttle {bench_args.throttle or 'none'}")
+    print(f"{'threads':>7} {'elapsed':>9} {'reports/s':>9} {'MB/s':>6} {'dl p50':>8} {'dl p95':>8} {'dl p99':>8} "
+          f"{'dl max':>8} {'search p95':>10} {'searches':>8} {'server 5xx/429':>14} {'missing':>7} "
+          f"{'corrupt':>7}")
+    for concurrency in [int(value) for value in bench_args.concurrency.split(',')]:
+        """Each run gets a new server, so that the fault draws repeat with the seed"""
+        fake = fake_hkex.FakeHKEX(rows, files, bench_args.latency, bench_args.jitter, bench_args.slow_rate,
+                                  bench_args.slow_latency, bench_args.error_rate, bench_args.throttle,
+                                  bench_args.seed)
+        server, base_url = fake_hkex.start_server(fake)
+        try:
+            result = run_download(base_url, concurrency, bench_args, rows, hashes)
+        finally:
+            server.shutdown()
+            server.server_close()
+        print(f"{concurrency:>7} {result['elapsed']:>8.2f}s {result['reports'] / result['elapsed']:>9.1f} "
+              f"{size_mb * result['reports'] / len(rows) / result['elapsed']:>6.1f} "
+              + " ".join(f"{result[key] * 1000:>6.0f}ms" for key in ['download_p50', 'download_p95', 'download_p99',
+                                                                   'download_max'])
+              + f" {result['search_p95'] * 1000:>8.0f}ms {result['searches']:>8} "
+              f"{fake.stats['errors']:>10}/{fake.stats['throttled']:<3} {result['missing']:>7} {result['corrupt']:>7}")
+        if result['error'] is not None:
+            print(f"  run failed: {result['error']!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,30 +6,67 @@ from datetime import datetime
 import traceback
 import sys
 import time
-from .utils import module_path, download_path, reports_path, mda_path, mda_text_path, metadata_db
-from .utils import module_start_time, t1codeVal, t2codeVal, from_date, to_date
+from .utils import config
 from .utils import logger
 from . import get_report
 from . import get_mda
 from . import extract_text
+from . import pipeline
+from . import metrics
 
 
-def main():
+def main(argv=None):
+    """
+    Command line entry point. The configuration is loaded here rather than on import.
+    :param argv: command line arguments, sys.argv[1:] if None
+    :return: exit status, 1 if a search failed and reports are missing, else 0 or None
+    """
+    config.load(argv)
+    exporter = None
+    if config.metrics_format:
+        exporter = metrics.Exporter(config.metrics_path, config.metrics_format, config.metrics_interval).start()
     try:
-        if not get_report.main():
-            return
-        if not get_mda.main():
-            return
-        if not extract_text.main():
-            return
-        elapsed_time = time.time() - module_start_time
+        if config.tail_mode:
+            """Tail passes always run pipelined, so that watermarks move only past extracted filings. A failed pass is
+            logged and the next one polls again from the same watermarks"""
+            while True:
+                try:
+                    if not pipeline.main():
+                        return
+                except Exception:
+                    logger.exception('Tail pass failed')
+                    if not config.poll_interval:
+                        return
+                if not config.poll_interval:
+                    break
+                logger.info(f"Next tail pass in {config.poll_interval}s")
+                time.sleep(config.poll_interval)
+        elif config.pipeline_mode:
+            if not pipeline.main():
+                return
+        else:
+            if not get_report.main():
+                return
+            if not get_mda.main():
+                return
+            if not extract_text.main():
+                return
+        elapsed_time = time.time() - config.module_start_time
         logger.info(f"Module total elapsed time: {elapsed_time}")
         logger.info('=' * 65)
-        metadata_db.commit()
-        metadata_db.close()
+        config.metadata_db.commit()
+        config.metadata_db.close()
+        if get_report.search_failures > 0:
+            logger.error(f"Incomplete run: {get_report.search_failures} searches failed and their reports are missing")
+            return 1
+        return 0
     except Exception:
         logger.debug(traceback.print_exception(*sys.exc_info()))
+    finally:
+        if exporter is not None:
+            exporter.stop()
+            logger.info(f"Metrics written to {config.metrics_path}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,333 @@
+"""
+This script keeps the metrics of a run: per-file timings of each step, counters of outcomes and bytes, and gauges
+such as cache hit rates. Timings keep the slowest files of each step, so that the documents dominating wall time can
+be found. With --metrics, they are written as JSON or as a Prometheus textfile to the download path at the end of the
+run and every --metrics_interval seconds during it.
+Documents taking longer than --slow_doc_seconds are written to the slow-document log with the time of each step, and
+with --profile, each stage is run under cProfile.
+"""
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial, wraps
+
+SLOWEST_FILES = 20  ## files kept per timing, slowest first
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  ## Prometheus histogram bounds of *_seconds
+PROMETHEUS_PREFIX = 'hkex_text_'
+PROFILE_TOP_FUNCTIONS = 25  ## functions logged per stage profile, by cumulative time
+
+logger = logging.getLogger('hkex-text')
+local = threading.local()  ## document being processed by the current thread
+
+
+class Registry:
+    """
+    Thread-safe store of counters, gauges and observations, keyed by name and labels. Observations keep their count,
+    sum and maximum, bucket counts for names ending in _seconds, and the slowest files if a file is given.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.observations = {}
+        self.slowest = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, file=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.observations:
+                buckets = [0] * len(SECONDS_BUCKETS) if name.endswith('_seconds') else None
+                self.observations[key] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': buckets}
+            observation = self.observations[key]
+            observation['count'] += 1
+            observation['sum'] += value
+            observation['max'] = max(observation['max'], value)
+            if observation['buckets'] is not None:
+                for idx, bound in enumerate(SECONDS_BUCKETS):
+                    if value <= bound:
+                        observation['buckets'][idx] += 1
+            if file is not None:
+                slowest = self.slowest.setdefault(name, [])
+                """A min-heap of the slowest files, so that the fastest of them is the one replaced"""
+                if len(slowest) < SLOWEST_FILES:
+                    heapq.heappush(slowest, (value, file))
+                elif value > slowest[0][0]:
+                    heapq.heapreplace(slowest, (value, file))
+
+    @contextmanager
+    def timer(self, name, file=None, **labels):
+        """Observes the seconds spent in the with block, also if it raises"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            self.observe(name, elapsed_time, file=file, **labels)
+            record = getattr(local, 'document', None)
+            if record is not None:
+                step = name[:-len('_seconds')] if name.endswith('_seconds') else name
+                record['steps'][step] = record['steps'].get(step, 0.0) + elapsed_time
+
+    def drain(self):
+        """:return: the records kept so far, which are cleared, for merge() in another process"""
+        with self.lock:
+            records = (self.counters, self.gauges, self.observations, self.slowest)
+            self.counters, self.gauges, self.observations, self.slowest = {}, {}, {}, {}
+        return records
+
+    def merge(self, records):
+        counters, gauges, observations, slowest = records
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, other in observations.items():
+                if key not in self.observations:
+                    self.observations[key] = other
+                    continue
+                observation = self.observations[key]
+                observation['count'] += other['count']
+                observation['sum'] += other['sum']
+                observation['max'] = max(observation['max'], other['max'])
+                if observation['buckets'] is not None:
+                    observation['buckets'] = [a + b for a, b in zip(observation['buckets'], other['buckets'])]
+            for name, files in slowest.items():
+                merged = self.slowest.setdefault(name, [])
+                for item in files:
+                    if len(merged) < SLOWEST_FILES:
+                        heapq.heappush(merged, item)
+                    elif item[0] > merged[0][0]:
+                        heapq.heapreplace(merged, item)
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps({
+                'updated': time.strftime('%Y%m%d %H:%M:%S'), 'elapsed_seconds': time.time() - self.start_time,
+                'counters': [dict(name=name, labels=dict(labels), value=value)
+                             for (name, labels), value in sorted(self.counters.items())],
+                'gauges': [dict(name=name, labels=dict(labels), value=value)
+                           for (name, labels), value in sorted(self.gauges.items())],
+                'observations': [dict(name=name, labels=dict(labels), count=observation['count'],
+                                      sum=observation['sum'], max=observation['max'],
+                                      mean=observation['sum'] / observation['count'])
+                                 for (name, labels), observation in sorted(self.observations.items())],
+                'slowest': {name: [dict(file=file, value=value) for value, file in sorted(files, reverse=True)]
+                            for name, files in sorted(self.slowest.items())},
+            }, indent=2, ensure_ascii=False)
+
+    def to_prometheus(self):
+        """Text exposition format, for node_exporter's textfile collector"""
+        lines = []
+
+        def series(name, labels, value, extra=()):
+            label_text = ','.join(f'{key}="{label_value}"' for key, label_value in list(labels) + list(extra))
+            lines.append(f"{PROMETHEUS_PREFIX}{name}{{{label_text}}} {value}" if label_text
+                         else f"{PROMETHEUS_PREFIX}{name} {value}")
+
+        with self.lock:
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}elapsed_seconds gauge")
+            series('elapsed_seconds', (), time.time() - self.start_time)
+            for kind, store in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name in sorted(set(name for name, _ in store)):
+                    lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} {kind}")
+                    for (key_name, labels), value in sorted(store.items()):
+                        if key_name == name:
+                            series(name, labels, value)
+            for name in sorted(set(name for name, _ in self.observations)):
+                keys = [key for key in sorted(self.observations) if key[0] == name]
+                histogram = self.observations[keys[0]]['buckets'] is not None
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} {'histogram' if histogram else 'summary'}")
+                for key_name, labels in keys:
+                    observation = self.observations[(key_name, labels)]
+                    if histogram:
+                        for bound, count in zip(SECONDS_BUCKETS, observation['buckets']):
+                            series(f"{name}_bucket", labels, count, [('le', bound)])
+                        series(f"{name}_bucket", labels, observation['count'], [('le', '+Inf')])
+                    series(f"{name}_count", labels, observation['count'])
+                    series(f"{name}_sum", labels, observation['sum'])
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name}_max gauge")
+                for key_name, labels in keys:
+                    series(f"{name}_max", labels, self.observations[(key_name, labels)]['max'])
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+"""A forked worker process starts empty, with a lock that no thread of the parent can be holding"""
+os.register_at_fork(after_in_child=registry.__init__)
+
+
+"""
+Set while a stage runs under --profile on the main thread, which is the one driving process pools, so that pool_map
+profiles the calls in worker processes too and adds them to worker_stats. Forked worker processes inherit the flag.
+"""
+profile_workers = False
+worker_stats = None
+
+
+def run_recorded(func, *args):
+    """
+    Calls func in a worker process for pool_map.
+    :return: (result, metrics records, cProfile stats of the call or None)
+    """
+    if not profile_workers:
+        return func(*args), registry.drain(), None
+    import cProfile
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args)
+    profiler.create_stats()
+    return result, registry.drain(), profiler.stats
+
+
+class ProfileStats:
+    """Holds stats returned by run_recorded, in the form pstats.Stats.add expects of a profiler"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def pool_map(executor, func, *iterables, chunksize=1):
+    """Like executor.map, merging the metrics func records in the worker processes into this process's registry"""
+    for result, records, stats in executor.map(partial(run_recorded, func), *iterables, chunksize=chunksize):
+        registry.merge(records)
+        if stats is not None and worker_stats is not None:
+            worker_stats.add(ProfileStats(stats))
+        yield result
+
+
+@contextmanager
+def document(stage, fpath):
+    """
+    Times the processing of one document by the current thread. Timers in the with block are recorded as its steps,
+    and annotate() adds fields such as its page count. If it takes --slow_doc_seconds or longer, it is logged and
+    appended to hkex-text-slow.jsonl.
+    """
+    record = {'stage': stage, 'file_path': fpath, 'pages': None, 'bytes': None, 'seconds': None, 'steps': {}}
+    outer = getattr(local, 'document', None)
+    local.document = record
+    start_time = time.perf_counter()
+    try:
+        yield record
+    finally:
+        local.document = outer
+        record['seconds'] = time.perf_counter() - start_time
+        from .utils import config
+        if config.slow_doc_seconds and record['seconds'] >= config.slow_doc_seconds:
+            log_slow_document(record, config.slow_doc_path)
+
+
+def annotate(**fields):
+    """Adds fields to the record of the document the current thread is processing, if any"""
+    record = getattr(local, 'document', None)
+    if record is not None:
+        record.update(fields)
+
+
+def log_slow_document(record, fpath):
+    if record['bytes'] is None and os.path.exists(record['file_path']):
+        record['bytes'] = os.path.getsize(record['file_path'])
+    record = dict(record, time=datetime.now().strftime('%Y%m%d %H:%M:%S'))
+    steps = ', '.join(f"{step} {seconds:.1f}s" for step, seconds in
+                      sorted(record['steps'].items(), key=lambda item: item[1], reverse=True))
+    logger.warning(f"Slow document: {record['stage']} took {record['seconds']:.1f}s on {record['file_path']} "
+                   f"({record['pages']} pages, {record['bytes']} bytes): {steps}")
+    """One short write per line in append mode, so that lines of worker processes do not interleave"""
+    with open(fpath, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+@contextmanager
+def stage_profile(stage, profiles_path):
+    """
+    Runs the with block under cProfile, along with the pool_map calls in worker processes, then dumps the stats to
+    profiles_path/{stage}_{yyyymmdd_HHMMSS}.prof and logs the functions with the most cumulative time. cProfile only
+    sees the current thread, so stages running on several threads profile each of them on their own.
+    """
+    import cProfile
+    import io
+    import pstats
+    global profile_workers, worker_stats
+    main_thread = threading.current_thread() is threading.main_thread()
+    profiler = cProfile.Profile()
+    stats = pstats.Stats()
+    if main_thread:
+        profile_workers, worker_stats = True, stats
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if main_thread:
+            profile_workers, worker_stats = False, None
+        stats.add(profiler)
+        os.makedirs(profiles_path, exist_ok=True)
+        fpath = os.path.join(profiles_path, f"{stage}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+        stats.dump_stats(fpath)
+        report = io.StringIO()
+        stats.stream = report
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        logger.info(f"Profile of {stage} written to {fpath}\n{report.getvalue()}")
+
+
+def profiled(stage):
+    """Decorates a stage entry point to run under stage_profile with --profile"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            from .utils import config
+            if not config.profile:
+                return func(*args, **kwargs)
+            with stage_profile(stage, config.profiles_path):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Exporter:
+    """Writes the registry to a file every `interval` seconds on a daemon thread, and once more on stop()"""
+    def __init__(self, fpath, metrics_format, interval):
+        self.fpath = fpath
+        self.metrics_format = metrics_format
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def write(self):
+        """Replaces the file atomically, so that a collector never reads a partial file"""
+        text = registry.to_prometheus() if self.metrics_format == 'prometheus' else registry.to_json()
+        tmp_fpath = f"{self.fpath}.{os.getpid()}.tmp"
+        with open(tmp_fpath, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_fpath, self.fpath)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self.run, name='metrics_exporter', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.write()
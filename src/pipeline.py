@@ -0,0 +1,175 @@
+"""
+This script runs report download, MD&A extraction and text extraction as overlapping stages. Each downloaded report
+is handed to the MD&A worker through a bounded queue, and each extracted MD&A PDF is handed on to the text worker.
+The MD&A PDFs downloaded for HTML annual reports go to the text worker directly.
+"""
+import os
+import queue
+import threading
+import time
+from .utils import config
+from .utils import logger
+from . import utils, get_report, get_mda, extract_text, metrics
+
+COMMIT_INTERVAL = 30  ## seconds between commits of metadata.db and the ledger by a pipeline worker
+
+
+def split_folder(fpath):
+    """Returns (source_path, folder, file) the same way the batch stages walk their directories."""
+    parent, file = os.path.split(fpath)
+    if not config.subfolders_required:
+        return parent, '', file
+    source_path, folder = os.path.split(parent)
+    return source_path, folder, file
+
+
+def route_report(mda_queue, text_queue):
+    """
+    Returns the on_report callback of get_report. Reports go to the MD&A worker, and the MD&A PDFs that get_report
+    saves itself for HTML annual reports go straight to the text worker.
+    """
+    mda_root = os.path.abspath(config.mda_path)
+
+    def on_report(fpath):
+        if os.path.commonpath([mda_root, os.path.abspath(fpath)]) == mda_root:
+            text_queue.put(fpath)
+        else:
+            mda_queue.put(fpath)
+    return on_report
+
+
+def commit_due(last_commit):
+    """
+    Commits metadata.db and the ledger if COMMIT_INTERVAL seconds have passed since last_commit, so that the rows of a
+    long run are saved as it goes, the way the batch stages commit after each folder.
+    :return: time of the last commit
+    """
+    if time.monotonic() - last_commit < COMMIT_INTERVAL:
+        return last_commit
+    utils.metadata_commit()
+    utils.ledger_commit()
+    return time.monotonic()
+
+
+@metrics.profiled('mda')
+def mda_worker(mda_queue, text_queue, failed):
+    """:param failed: set collecting the NEWS_ID of the reports that failed in either worker"""
+    cur = config.metadata_db.cursor()
+    prior_titles = get_mda.load_prior_titles()
+    last_commit = time.monotonic()
+    while True:
+        item = mda_queue.get()
+        metrics.registry.observe('queue_depth', mda_queue.qsize(), queue='mda')
+        if item is None:
+            text_queue.put(None)
+            break
+        try:
+            source_path, folder, file = split_folder(item)
+            if not file.lower().endswith('pdf') or utils.ledger_is_done('mda', item):
+                continue
+            sha256 = utils.file_sha256(item)
+            original = utils.ledger_find_content('mda', item, sha256)
+            row = get_mda.reuse_mda(folder, file, config.mda_path, original) if original is not None else None
+            if row is None:
+                prior_title = prior_titles.get(file.split("_")[0])
+                row = get_mda.extract_mda(source_path, folder, file, config.mda_path, prior_title)
+            if row[-1] == 'success':
+                prior_titles[row[3]] = row[6]
+            get_mda.insert_mda_rows(cur, [row])
+            utils.ledger_record('mda', item, status=row[-1], output=row[1], sha256=sha256)
+            if row[-1] == 'success':
+                text_queue.put(row[1])
+            elif row[-1] == 'error':
+                failed.add(get_report.report_news_id(item))
+        except Exception:
+            logger.exception(f"[MD&A worker failed] {item}")
+            failed.add(get_report.report_news_id(item))
+            metrics.registry.inc('files_total', stage='mda', status='error')
+        finally:
+            last_commit = commit_due(last_commit)
+    cur.close()
+
+
+@metrics.profiled('text')
+def text_worker(text_queue, failed):
+    cur = config.metadata_db.cursor()
+    last_commit = time.monotonic()
+    while True:
+        item = text_queue.get()
+        metrics.registry.observe('queue_depth', text_queue.qsize(), queue='text')
+        if item is None:
+            break
+        try:
+            if utils.ledger_is_done('text', item):
+                continue
+            source_path, folder, file = split_folder(item)
+            sha256 = utils.file_sha256(item)
+            original = utils.ledger_find_content('text', item, sha256)
+            row = None
+            if original is not None:
+                row = extract_text.reuse_mda_text(source_path, folder, file, config.mda_text_path, original)
+            if row is None:
+                row = extract_text.extract_mda_text(source_path, folder, file, config.mda_text_path)
+            if row is not None:
+                extract_text.insert_mda_text_rows(cur, [row])
+            utils.ledger_record('text', item, status='success' if row is not None else 'exists', sha256=sha256)
+        except Exception:
+            logger.exception(f"[Text worker failed] {item}")
+            failed.add(get_report.report_news_id(item))
+            metrics.registry.inc('files_total', stage='text', status='error')
+        finally:
+            last_commit = commit_due(last_commit)
+    cur.close()
+
+
+def main():
+    logger.info('Start pipelined download, MD&A and text extraction')
+    script_start_time = time.time()
+    utils.init_db_mda()
+    utils.init_db_mda_text()
+    utils.migrate_daily_dbs()
+    utils.init_db_ledger()
+    for path in [config.reports_path, config.mda_path, config.mda_text_path]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    """Bounded queues block the upstream stage when a downstream stage falls behind"""
+    mda_queue = queue.Queue(maxsize=config.queue_size)
+    text_queue = queue.Queue(maxsize=config.queue_size)
+    failed = set()
+    workers = [threading.Thread(target=mda_worker, args=(mda_queue, text_queue, failed), name='mda_worker',
+                                daemon=True),
+               threading.Thread(target=text_worker, args=(text_queue, failed), name='text_worker', daemon=True)]
+    for worker in workers:
+        worker.start()
+
+    """In tail mode, watermarks are saved only once the new filings have been through both stages"""
+    watermarks = {}
+
+    def on_watermark(stockId, watermark, keys, download_failed, search_failed):
+        watermarks[stockId] = (watermark, keys, download_failed, search_failed)
+    try:
+        completed = get_report.main(on_report=route_report(mda_queue, text_queue), on_watermark=on_watermark)
+    finally:
+        """The sentinel drains both queues in order before the workers exit. get_report puts nothing on text_queue after
+        it returns, so its MD&A PDFs are ahead of the text sentinel"""
+        mda_queue.put(None)
+        for worker in workers:
+            worker.join()
+        utils.metadata_commit()
+        utils.ledger_commit()
+        get_mda.record_cache_metrics()
+    for stockId, (watermark, keys, download_failed, search_failed) in watermarks.items():
+        if search_failed:
+            """Filings older than the failed search page may be missing, so the watermark stays"""
+            continue
+        """A filing that failed in a worker holds the watermark back like a failed download"""
+        newest = get_report.next_watermark(watermark, keys, download_failed | {key for key in keys if key[1] in failed})
+        if newest is not None and newest != watermark:
+            utils.save_watermark(config.t2codeVal, stockId, newest)
+
+    elapsed_time = time.time() - script_start_time
+    metrics.registry.observe('stage_seconds', elapsed_time, stage='pipeline')
+    logger.info(f"Pipeline complete. Elapsed time: {elapsed_time}")
+    logger.info('=' * 65)
+    return completed
@@ -0,0 +1,72 @@
+"""
+This script checks the MD&A matcher against the MD&A PDFs bundled in reports_data. Every sample report with an
+outline must match the title and page range its bundled MD&A PDF was named after, or no title if none was bundled for
+it. A change of the fuzzy scoring, such as another thefuzz or python-Levenshtein version, shows up here as mismatches.
+Titles are scored afresh, without hkex-text-titles.db.
+Usage: python -m hkex-text-mda.src.regression [--samples_path PATH]
+"""
+import argparse
+import os
+import sys
+from . import get_mda
+
+module_path = os.path.dirname(os.path.abspath(__file__))
+default_samples_path = os.path.join(os.path.dirname(module_path), 'reports_data')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Checks the MD&A matcher against the bundled MD&A PDFs.")
+    parser.add_argument("--samples_path", "-s", required=False, default=default_samples_path,
+                        help="Directory holding the 'hkex_reports' and 'hkex_reports_mda' folders of the samples. "
+                             "Default: ./reports_data")
+    return parser.parse_args()
+
+
+def list_files(samples_path, folder):
+    fpaths = []
+    for root, dirs, files in os.walk(os.path.join(samples_path, folder)):
+        fpaths += [os.path.join(root, file) for file in files if file.lower().endswith('pdf')]
+    return sorted(fpaths)
+
+
+def check_matches(samples_path):
+    """
+    Matches the outline of every sample report and compares the name its MD&A PDF would get with the bundled ones.
+    :return: list of (report, expected MD&A PDF or None, matched MD&A PDF or None) that differ, and the number checked
+    """
+    import fitz
+    cache = get_mda.TitleScoreCache(':memory:', max_size=0)
+    bundled = {}
+    for fpath in list_files(samples_path, 'hkex_reports_mda'):
+        file = os.path.basename(fpath)
+        bundled[file[:file.index('_pages_')]] = file
+    mismatches = []
+    checked = 0
+    for fpath in list_files(samples_path, 'hkex_reports'):
+        with fitz.open(fpath) as doc:
+            outline = [element for element in doc.get_toc() if element[0] == 1]
+        if len(outline) == 0:
+            continue
+        checked += 1
+        mda_match, start_page, end_page = get_mda.find_mda_range(outline, cache=cache)
+        matched = None
+        if not isinstance(mda_match, list):
+            matched = os.path.basename(get_mda.mda_fpath(fpath, mda_match, start_page, end_page, ''))
+        expected = bundled.get(os.path.splitext(os.path.basename(fpath))[0])
+        if matched != expected:
+            mismatches.append((os.path.basename(fpath), expected, matched))
+    return mismatches, checked
+
+
+def main():
+    args = parse_args()
+    mismatches, checked = check_matches(args.samples_path)
+    for report, expected, matched in mismatches:
+        print(f"{report}: expected {expected}, matched {matched}")
+    print(f"{checked - len(mismatches)} of {checked} sample reports match their bundled MD&A")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
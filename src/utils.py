@@ -3,13 +3,10 @@ Utilities script. Includes argparse, logging, global variables.
 Last updated: July 2022
 """
 import os
-import pandas as pd
-import PyPDF2
 import re
-import os
+import glob
 from collections import Counter
 import string
-import pikepdf
 import random
 import difflib
 import time
@@ -18,19 +15,38 @@ import argparse
 import sys
 from datetime import datetime, timedelta
 import logging
-import requests
 import json
-import random
+import threading
+import hashlib
+import shutil
+import tempfile
+from . import metrics
 
+"""
+pandas, PyPDF2, pikepdf and requests are imported by the functions using them, so that importing the package stays
+fast for the stages and for library use that do not need them.
+"""
 
-def get_stockId(stock_code):
+BASE_URL = 'https://www1.hkexnews.hk'  ## HKEXnews host, overridden by --base_url
+
+def get_stock_info(stock_code, rate_limiter=None, session=None, base_url=BASE_URL):
+    """
+    Looks a stock code up with HKEX's prefix search.
+    :param rate_limiter: RateLimiter shared by concurrent lookups. Without one, each lookup sleeps 0.05-0.5s afterwards.
+    :param session: requests.Session to send the lookup on
+    :param base_url: HKEXnews host, like --base_url
+    :return: (stockId, code, name) of the first match
+    """
+    import requests
     logger.info(f"get stockId for stock_code: {stock_code}")
     count=0
     while True:
         count += 1
         try:
-            res = requests.get(
-                f"https://www1.hkexnews.hk/search/prefix.do?&callback=callback&lang=EN&type=A&name={str(int(stock_code))}&market=SEHK")
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            res = (session or requests).get(
+                f"{base_url}/search/prefix.do?&callback=callback&lang=EN&type=A&name={str(int(stock_code))}&market=SEHK")
             res.raise_for_status()
             break
         except requests.exceptions.HTTPError as e:
@@ -38,7 +54,7 @@ def get_stockId(stock_code):
             time.sleep(random.randint(5, 15))
             if count > 10:
                 logger.error(f"HTTPError occurred 10+ times.")
-                raise f"HTTPError occurred 10+ times."
+                raise Exception(f"HTTPError occurred 10+ times.")
     res = res.text.replace('callback(', '').replace(";", "")[:-2].strip()
 
     res_json = json.loads(res)
@@ -46,9 +62,92 @@ def get_stockId(stock_code):
     code = res_json['stockInfo'][0]['code']
     name = res_json['stockInfo'][0]['name']
     logger.info(f"result – stockId: {stockId} code: {code} name: {name}")
-    time.sleep(random.randint(5, 50)*0.01)
+    if rate_limiter is None:
+        time.sleep(random.randint(5, 50)*0.01)
+
+    return stockId, code, name
+
+
+def get_stockId(stock_code):
+    return get_stock_info(stock_code)[0]
+
 
-    return stockId
+def init_db_stock_ids(db):
+    db.execute("""CREATE TABLE IF NOT EXISTS stock_ids 
+                (stock_code text PRIMARY KEY, stock_id integer, code text, name text, resolved_at real
+                )""")
+
+
+def resolve_stockIds(stock_codes, db=None, ttl_days=30, concurrency=4, rate_limit=2.0, base_url=BASE_URL):
+    """
+    Resolves stock codes to stockIds. Entries of the stock_ids table younger than ttl_days are used as they are, and
+    the other codes are looked up concurrently, sharing one session and rate limit, then stored.
+    :param db: metadata database holding the stock_ids table, or None to look every code up without storing it
+    :param ttl_days: age in days after which a stored stockId is looked up again. 0 looks every code up.
+    :return: stockIds in the order of stock_codes
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    start_time = time.time()
+    keys = [str(int(stock_code)) for stock_code in stock_codes]
+    resolved = {}
+    if db is not None and ttl_days > 0:
+        with db_lock:
+            init_db_stock_ids(db)
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                query = (f"SELECT stock_code, stock_id FROM stock_ids WHERE resolved_at >= ? "
+                         f"AND stock_code IN ({', '.join('?' * len(batch))})")
+                resolved.update(db.execute(query, [start_time - ttl_days * 86400] + batch).fetchall())
+
+    missing = list(dict.fromkeys(key for key in keys if key not in resolved))
+    if len(missing) > 0:
+        rate_limiter = RateLimiter(rate_limit)
+        session = new_session(concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            stock_infos = list(executor.map(lambda key: get_stock_info(key, rate_limiter, session, base_url), missing))
+        resolved.update((key, stock_info[0]) for key, stock_info in zip(missing, stock_infos))
+        if db is not None:
+            with db_lock:
+                init_db_stock_ids(db)
+                db.executemany("INSERT OR REPLACE INTO stock_ids VALUES (?, ?, ?, ?, ?)",
+                               [(key, stockId, code, name, time.time())
+                                for key, (stockId, code, name) in zip(missing, stock_infos)])
+                db.commit()
+    logger.info(f"Resolved {len(keys)} stock codes in {time.time() - start_time:.3f}s: "
+                f"{len(keys) - len(missing)} stored, {len(missing)} looked up")
+    return [resolved[key] for key in keys]
+
+
+class RateLimiter:
+    """
+    Thread-safe politeness limiter. Spaces out calls to wait() so that at most `rate` requests per second are
+    started across all threads sharing the limiter. A rate of 0 or None disables the limit.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            sleep_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+
+def new_session(pool_size):
+    """Creates a requests.Session keeping up to `pool_size` open connections per host."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
 parser = argparse.ArgumentParser(description="This script extracts Table of Contents from PDF files using keywords."
@@ -58,141 +157,507 @@ parser.add_argument("--download_path", "-dp", required=False, help='Absolute dir
 parser.add_argument("--stock_code", "-sc", required=False, help="Particular stock code of a company of interest, "
                                                                 "separated by commas. ex. '700' for TENCENT, '9988' "
                                                                 "for BABA. '700,9988' for both.")
+parser.add_argument("--stock_id_ttl", "-sit", required=False, type=float, default=30,
+                    help="Days for which a stockId resolved from a stock code is reused from metadata.db before it is "
+                         "looked up again. 0 looks every stock code up. Default: 30")
 parser.add_argument("--report_type", "-t2", required=True, help='-2 => All Financial Statements/ESG Information, '
                                                                 '40100 => Annual Report, 40200 => Semi-annual Report '
                                                                 '40300 => Quarterly Report 40400 => ESG '
                                                                 'Information/Report')
-parser.add_argument("--from_date", "-fd", required=True, help="From date of the report to be downloaded. "
+parser.add_argument("--from_date", "-fd", required=False, help="From date of the report to be downloaded. "
                                                               "Format='yyyymmdd' for days, 'yyyymm' for months, and "
                                                               "'yyyy' for years. For example, '2018' will include all "
                                                               "reports from 2018 to the year specified in --to_date. "
                                                               "NOTICE: The format of --from_date and --to_date should "
                                                               "match."
-                                                              "NOTICE2: The earliest date value limit is 2007 June.")
-parser.add_argument("--to_date", "-td", required=True, help="To date of the report to be downloaded. "
+                                                              "NOTICE2: The earliest date value limit is 2007 June. "
+                                                              "Required unless --tail is given, where it sets the "
+                                                              "start of the first pass.")
+parser.add_argument("--to_date", "-td", required=False, help="To date of the report to be downloaded. "
                                                             "Format='yyyymmdd' for days, 'yyyymm' for months, and "
                                                             "'yyyy' for years. For example, '2018' will include all "
                                                             "reports up to 2018 from the year specified in --from_date."
                                                             " NOTICE: The format of --from_date and --to_date should "
-                                                            "match")
-args = parser.parse_args(sys.argv[1:])
-
-module_start_time = time.time()
-today = datetime.strftime(datetime.today(), "%Y%m%d")
+                                                            "match. Required unless --tail is given.")
+parser.add_argument("--concurrency", "-c", required=False, type=int, default=4,
+                    help="Number of reports downloaded in parallel over pooled HTTP connections. Default: 4")
+parser.add_argument("--base_url", "-bu", required=False, default=BASE_URL,
+                    help="HKEXnews host that stock codes are looked up on and reports are searched and downloaded "
+                         "from, e.g. http://127.0.0.1:8480 for the fake server in fake_hkex.py. "
+                         f"Default: {BASE_URL}")
+parser.add_argument("--rate_limit", "-rl", required=False, type=float, default=2.0,
+                    help="Maximum number of HTTP requests started per second across all download threads. "
+                         "0 disables the limit. Default: 2.0")
+parser.add_argument("--pipeline", "-p", required=False, action="store_true",
+                    help="Runs download, MD&A extraction and text extraction as overlapping pipeline stages, passing "
+                         "each downloaded report on as soon as it is saved instead of running three full passes.")
+parser.add_argument("--queue_size", "-qs", required=False, type=int, default=8,
+                    help="Maximum number of reports waiting between two pipeline stages. Default: 8")
+parser.add_argument("--workers", "-w", required=False, type=int, default=1,
+                    help="Number of processes used for MD&A and text extraction. Default: 1")
+parser.add_argument("--force", "-f", required=False, default='',
+                    help="Stages to reprocess even if the processing ledger says a file is unchanged since its last "
+                         "run, separated by commas. ex. 'mda', 'text', 'mda,text' or 'all'.")
+parser.add_argument("--pdf_engine", "-pe", required=False, default='fitz', choices=['fitz', 'pypdf2'],
+                    help="Library used to write the MD&A page range. 'fitz' reuses the document already opened for "
+                         "outline matching, 'pypdf2' re-reads the report and copies pages one by one. Default: fitz")
+parser.add_argument("--pdf_garbage", "-pg", required=False, type=int, default=0, choices=range(0, 5),
+                    help="fitz garbage collection level (0-4) applied when writing MD&A PDFs. Default: 0")
+parser.add_argument("--pdf_deflate", "-pd", required=False, action="store_true",
+                    help="Compresses uncompressed streams when writing MD&A PDFs with fitz.")
+parser.add_argument("--layout", "-lo", required=False, action="store_true",
+                    help="Extracts MD&A text from the text blocks of each page, dropping running headers, footers and "
+                         "side tabs found by their position across pages instead of the most repeated lines. Use with "
+                         "--force text to rewrite the text files extracted without it.")
+parser.add_argument("--stream", "-st", required=False, action="store_true",
+                    help="Extracts MD&A text one page at a time, keeping the lines of each language in temporary files "
+                         "until they are cleaned, so that memory use does not grow with the page count. The text is the "
+                         "same as without it.")
+parser.add_argument("--tail", "-tl", required=False, action="store_true",
+                    help="Fetches only filings newer than the watermark stored for the report type and each stock, "
+                         "and runs them through the pipeline. The watermark moves forward once they are extracted, but not "
+                         "past a filing that failed, so that the next pass retries it. A stock whose search fails keeps "
+                         "its watermark.")
+parser.add_argument("--poll_interval", "-pi", required=False, type=float, default=0,
+                    help="With --tail, seconds to wait between passes. 0 runs a single pass. Default: 0")
+parser.add_argument("--title_cache_size", "-tcs", required=False, type=int, default=10000,
+                    help="Number of outline titles whose MD&A match scores are kept in memory. Scores are also kept "
+                         "in hkex-text-titles.db across runs. 0 disables the cache. Default: 10000")
+parser.add_argument("--slow_doc_seconds", "-sds", required=False, type=float, default=30,
+                    help="Documents taking this many seconds or more in a stage are logged and appended to "
+                         "hkex-text-slow.jsonl, with their page count, size and the time of each step. 0 disables the "
+                         "log. Default: 30")
+parser.add_argument("--profile", "-pf", required=False, action="store_true",
+                    help="Runs each stage under cProfile, including its worker processes, and writes the stats to the "
+                         "'profiles' folder as {stage}_{yyyymmdd_HHMMSS}.prof. The slowest functions are logged.")
+parser.add_argument("--metrics", "-m", required=False, choices=['json', 'prometheus'],
+                    help="Writes per-step timings, the slowest files of each step, outcome counts and cache hit rates "
+                         "to hkex-text-metrics.json, or hkex-text-metrics.prom as a Prometheus textfile.")
+parser.add_argument("--metrics_interval", "-mi", required=False, type=float, default=60,
+                    help="With --metrics, seconds between metrics file updates during the run. 0 writes it at the end "
+                         "only. Default: 60")
 
 module_path = os.path.dirname(os.path.abspath(__file__))
-if args.download_path:
-    download_path = args.download_path
-else:
-    download_path = os.path.join(module_path, 'reports_data')
-if not os.path.exists(download_path):
-    os.makedirs(download_path)
-reports_path = os.path.join(download_path, 'hkex_reports')
-mda_path = os.path.join(download_path, 'hkex_reports_mda')
-mda_text_path = os.path.join(download_path, 'hkex_reports_mda_text')
-metadata_db = sqlite3.connect(os.path.join(download_path, f'metadata_{today}.db'))
-
+db_lock = threading.Lock()  ## serializes metadata_db and state_db writes coming from pipeline worker threads
+logger = logging.getLogger('hkex-text')
 
-"""logger set up"""
-log_path = os.path.join(download_path, 'hkex-text.log')
 
-logger = logging.getLogger('hkex-text')
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter(fmt='%(asctime)s %(levelname)s - %(message)s', datefmt='%Y%m%d %H:%M:%S')
-
-file_handler = logging.FileHandler(log_path)
-file_handler.setFormatter(formatter)
-file_handler.setLevel(logging.DEBUG)
-file_handler.set_name('my_file_handler')
-logger.addHandler(file_handler)
-
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-console_handler.setLevel(logging.DEBUG)
-console_handler.set_name('my_console_handler')
-logger.addHandler(console_handler)
-
-ts = time.time()
-logger.info('=' * 65)
-logger.info('Analysis started at {0}'.format(datetime.fromtimestamp(ts).strftime('%Y%m%d %H:%M:%S')))
-logger.info('Command line:\t{0}'.format(sys.argv[0]))
-logger.info('Arguments:\t\t{0}'.format(' '.join(sys.argv[:])))
-logger.info('=' * 65)
-"""logger set up"""
-
-
-"""Below codes are required when downloading the reports. Uncomment as needed or pass in arguments from the terminal."""
-if args.stock_code:
-    stockCodeList = args.stock_code.split(',')
-    stockIdList = [get_stockId(stockCode) for stockCode in stockCodeList]
-else:
-    stockCodeList = []
-    stockIdList = [-1]
-
-# t1codeVal = -2 ## => All
-t1codeVal = 40000 ## => Financial Statements/ESG Information
-
-# t2codeVal = -2 ## => All (under Financial Statements/ESG Information if t1codeVal == 40000 and entire data if t1codeVal == -2)
-# t2codeVal = 40100 ## => Annual Report (under Financial Statements/ESG Information)
-# t2codeVal = 40200 ## => Semi-annual Report (under Financial Statements/ESG Information)
-# t2codeVal = 40300 ## => Quarterly Report (under Financial Statements/ESG Information)
-# t2codeVal = 40400 ## => Environment, Social and Governance Information/Report (under Financial Statements/ESG Information)
-t2codeVal = args.report_type
-
-from_date = args.from_date
-to_date = args.to_date
-subfolders_required = True
-if len(from_date) == 8 and len(to_date) == 8:
-    subfolders_required = False
-    if (datetime.strptime(to_date, '%Y%m%d') - datetime.strptime(from_date, '%Y%m%d')) > timedelta(days=365):
-        raise Exception("Date range from_date to to_date should be less than 365 days. Please use monthly or yearly "
-                        "range if you need data for a range bigger than 1 year.")
-
-if len(stockIdList) > 0:
-    logger.info(f"Selected stockCode list: {stockCodeList}")
-    logger.info(f"Selected stockId list: {stockIdList}")
-
-if t2codeVal == '-2':
-    logger.info("Selected t2code==-2, Processing 'All' report types under 'Financial Statements/ESG Information'.")
-elif t2codeVal == '40100':
-    logger.info("Selected t2code==40100, Processing 'Annual Report' report type")
-elif t2codeVal == '40200':
-    logger.info("Selected t2code==40200, Processing 'Semi-annual Report' report type")
-elif t2codeVal == '40300':
-    logger.info("Selected t2code==40300, Processing 'Quarterly Report' report type")
-elif t2codeVal == '40400':
-    logger.info("Selected t2code==40400, Processing 'ESG Information/Report' report type")
-logger.info(f"Selected date range is from {from_date} to {to_date}")
-logger.info('=' * 65)
+def setup_logger(log_path):
+    """Attaches the file and console handlers, replacing the ones of an earlier load"""
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(fmt='%(asctime)s %(levelname)s - %(message)s', datefmt='%Y%m%d %H:%M:%S')
+    for handler in list(logger.handlers):
+        if handler.get_name() in ['my_file_handler', 'my_console_handler']:
+            logger.removeHandler(handler)
+            handler.close()
+
+    file_handler = logging.FileHandler(log_path)
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.set_name('my_file_handler')
+    logger.addHandler(file_handler)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    console_handler.setLevel(logging.DEBUG)
+    console_handler.set_name('my_console_handler')
+    logger.addHandler(console_handler)
+
+
+class Config:
+    """
+    Settings and shared resources of a run: parsed arguments, paths, databases and log handlers. Nothing is parsed,
+    created or opened on import. Loading is explicit: the CLI entry points call load(), and the worker processes of a
+    stage get the parent's arguments through init_worker. Reading a setting before that raises AttributeError, so that
+    a library user never has the host's sys.argv parsed behind their back.
+    """
+    def __getattr__(self, name):
+        """Only reached for settings that are not set"""
+        if name.startswith('__') or self.__dict__.get('loaded'):
+            raise AttributeError(name)
+        raise AttributeError(f"config.{name} is not set, since the configuration is not loaded. Call config.load() "
+                             f"first, as the command line entry points do.")
+
+    def load(self, argv=None):
+        """
+        :param argv: command line arguments, sys.argv[1:] if None
+        :return: self
+        """
+        args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+        if not args.tail and (args.from_date is None or args.to_date is None):
+            parser.error("the following arguments are required unless --tail is given: --from_date/-fd, --to_date/-td")
+        self.set_args(args)
+        if not os.path.exists(self.download_path):
+            os.makedirs(self.download_path)
+        ## metadata_db accumulates the rows of every run. WAL lets readers query it while a stage is writing
+        self.metadata_db = sqlite3.connect(os.path.join(self.download_path, 'metadata.db'), check_same_thread=False)
+        self.metadata_db.execute("PRAGMA journal_mode=WAL")
+        self.metadata_db.execute("PRAGMA synchronous=NORMAL")
+        ## state_db keeps the processing ledger, which tracks files rather than reports
+        self.state_db = sqlite3.connect(os.path.join(self.download_path, 'hkex-text-state.db'),
+                                        check_same_thread=False)
+
+        """logger set up"""
+        setup_logger(os.path.join(self.download_path, 'hkex-text.log'))
+        ts = time.time()
+        logger.info('=' * 65)
+        logger.info('Analysis started at {0}'.format(datetime.fromtimestamp(ts).strftime('%Y%m%d %H:%M:%S')))
+        logger.info('Command line:\t{0}'.format(sys.argv[0]))
+        logger.info('Arguments:\t\t{0}'.format(' '.join(sys.argv[:] if argv is None else sys.argv[:1] + argv)))
+        logger.info('=' * 65)
+        """logger set up"""
+
+        if args.stock_code:
+            self.stockCodeList = args.stock_code.split(',')
+            self.stockIdList = resolve_stockIds(self.stockCodeList, self.metadata_db, self.stock_id_ttl,
+                                                self.concurrency, self.rate_limit, self.base_url)
+        else:
+            self.stockCodeList = []
+            self.stockIdList = [-1]
+
+        if len(self.stockIdList) > 0:
+            logger.info(f"Selected stockCode list: {self.stockCodeList}")
+            logger.info(f"Selected stockId list: {self.stockIdList}")
+
+        if self.t2codeVal == '-2':
+            logger.info("Selected t2code==-2, Processing 'All' report types under "
+                        "'Financial Statements/ESG Information'.")
+        elif self.t2codeVal == '40100':
+            logger.info("Selected t2code==40100, Processing 'Annual Report' report type")
+        elif self.t2codeVal == '40200':
+            logger.info("Selected t2code==40200, Processing 'Semi-annual Report' report type")
+        elif self.t2codeVal == '40300':
+            logger.info("Selected t2code==40300, Processing 'Quarterly Report' report type")
+        elif self.t2codeVal == '40400':
+            logger.info("Selected t2code==40400, Processing 'ESG Information/Report' report type")
+        if self.tail_mode:
+            logger.info(f"Tail mode, polling every {self.poll_interval}s" if self.poll_interval
+                        else "Tail mode, single pass")
+        else:
+            logger.info(f"Selected date range is from {self.from_date} to {self.to_date}")
+        logger.info(f"Download concurrency: {self.concurrency}, "
+                    f"rate limit: {self.rate_limit if self.rate_limit else 'none'} req/s")
+        logger.info('=' * 65)
+        return self
+
+    def set_args(self, args):
+        """
+        Sets the settings derived from parsed arguments, without creating directories, opening the databases,
+        attaching log handlers or resolving stock codes.
+        :param args: argparse.Namespace as returned by parser.parse_args
+        :return: self
+        """
+        self.loaded = True
+        self.args = args
+        self.module_start_time = time.time()
+        self.today = datetime.strftime(datetime.today(), "%Y%m%d")
+
+        if args.download_path:
+            self.download_path = args.download_path
+        else:
+            self.download_path = os.path.join(module_path, 'reports_data')
+        self.reports_path = os.path.join(self.download_path, 'hkex_reports')
+        self.mda_path = os.path.join(self.download_path, 'hkex_reports_mda')
+        self.mda_text_path = os.path.join(self.download_path, 'hkex_reports_mda_text')
+        ## blobs_path stores each downloaded file once by SHA-256; report paths are hardlinks into it
+        self.blobs_path = os.path.join(self.download_path, 'hkex_blobs')
+
+        """Below codes are required when downloading the reports. Uncomment as needed or pass in arguments from the terminal."""
+        # self.t1codeVal = -2 ## => All
+        self.t1codeVal = 40000 ## => Financial Statements/ESG Information
+
+        # self.t2codeVal = -2 ## => All (under Financial Statements/ESG Information if t1codeVal == 40000 and entire data if t1codeVal == -2)
+        # self.t2codeVal = 40100 ## => Annual Report (under Financial Statements/ESG Information)
+        # self.t2codeVal = 40200 ## => Semi-annual Report (under Financial Statements/ESG Information)
+        # self.t2codeVal = 40300 ## => Quarterly Report (under Financial Statements/ESG Information)
+        # self.t2codeVal = 40400 ## => Environment, Social and Governance Information/Report (under Financial Statements/ESG Information)
+        self.t2codeVal = args.report_type
+
+        self.from_date = args.from_date
+        self.to_date = args.to_date
+        self.concurrency = max(args.concurrency, 1)
+        self.rate_limit = args.rate_limit
+        self.base_url = args.base_url.rstrip('/')
+        self.stock_id_ttl = args.stock_id_ttl
+        self.pipeline_mode = args.pipeline
+        self.tail_mode = args.tail
+        self.poll_interval = max(args.poll_interval, 0)
+        self.queue_size = max(args.queue_size, 1)
+        self.workers = max(args.workers, 1)
+        self.force_stages = [stage.strip() for stage in args.force.split(',') if stage.strip()]
+        if 'all' in self.force_stages:
+            self.force_stages = ['mda', 'text']
+        self.pdf_engine = args.pdf_engine
+        self.pdf_garbage = args.pdf_garbage
+        self.pdf_deflate = args.pdf_deflate
+        self.layout = args.layout
+        self.stream = args.stream
+        self.title_cache_size = max(args.title_cache_size, 0)
+        self.slow_doc_seconds = max(args.slow_doc_seconds, 0)
+        self.slow_doc_path = os.path.join(self.download_path, 'hkex-text-slow.jsonl')
+        self.profile = args.profile
+        self.profiles_path = os.path.join(self.download_path, 'profiles')
+        self.metrics_format = args.metrics
+        self.metrics_interval = max(args.metrics_interval, 0)
+        self.metrics_path = os.path.join(self.download_path, 'hkex-text-metrics.prom' if args.metrics == 'prometheus'
+                                         else 'hkex-text-metrics.json')
+        self.subfolders_required = True
+        if self.tail_mode:
+            """Tail passes span days to months, so their reports are saved in yyyy_mm folders"""
+            pass
+        elif len(self.from_date) == 8 and len(self.to_date) == 8:
+            self.subfolders_required = False
+            date_range = datetime.strptime(self.to_date, '%Y%m%d') - datetime.strptime(self.from_date, '%Y%m%d')
+            if date_range > timedelta(days=365):
+                raise Exception("Date range from_date to to_date should be less than 365 days. Please use monthly or "
+                                "yearly range if you need data for a range bigger than 1 year.")
+        return self
+
+
+config = Config()
+
+
+def init_worker(args):
+    """
+    Initializer of the process pools of the stages. A forked worker inherits the loaded configuration, while a spawned
+    one starts with none and gets the settings of the parent's arguments, and the log file, but no databases.
+    :param args: config.args of the parent process
+    """
+    if not config.__dict__.get('loaded'):
+        config.set_args(args)
+        setup_logger(os.path.join(config.download_path, 'hkex-text.log'))
 
 
 def init_db():
-    cur = metadata_db.cursor()
+    cur = config.metadata_db.cursor()
     cur.execute("""CREATE TABLE IF NOT EXISTS metadata 
                 (file_info text, file_name text, file_path text, month text, date_time text, stock_code integer, 
                 stock_name text, title text, news_id integer, short_text text, long_text text, total_count integer, 
-                file_type text, file_link text, dod_web_path text
+                file_type text, file_link text, dod_web_path text, sha256 text
                 )""")
+    if 'sha256' not in [row[1] for row in cur.execute("PRAGMA table_info(metadata)")]:
+        """metadata tables created before the blob store lack the column"""
+        cur.execute("ALTER TABLE metadata ADD COLUMN sha256 text")
+    cur.execute("CREATE INDEX IF NOT EXISTS metadata_news_id ON metadata (news_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS metadata_stock_code ON metadata (stock_code)")
+    cur.execute("CREATE INDEX IF NOT EXISTS metadata_month ON metadata (month)")
     cur.close()
 
 
 def init_db_mda():
-    cur = metadata_db.cursor()
+    cur = config.metadata_db.cursor()
     cur.execute("""CREATE TABLE IF NOT EXISTS metadata_mda 
                 (file_name text, file_path text, month text, ticker text, outline text, mda_extracted text, 
                 mda_title_best_match text, status text
                 )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS metadata_mda_ticker ON metadata_mda (ticker)")
+    cur.execute("CREATE INDEX IF NOT EXISTS metadata_mda_month ON metadata_mda (month)")
+    cur.execute("CREATE INDEX IF NOT EXISTS metadata_mda_status ON metadata_mda (status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS metadata_mda_file_name ON metadata_mda (file_name)")
     cur.close()
 
 
 def init_db_mda_text():
-    cur = metadata_db.cursor()
+    cur = config.metadata_db.cursor()
     cur.execute("""CREATE TABLE IF NOT EXISTS metadata_mda_text 
                 (file_name text, file_path text, month text, eng_extracted text, chi_extracted text
                 )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS metadata_mda_text_month ON metadata_mda_text (month)")
     cur.close()
 
 
+def migrate_daily_dbs():
+    """
+    Imports the metadata_yyyymmdd.db files written by earlier versions, which opened a new database every day, into
+    metadata.db. Each file is imported once, as recorded in the migrations table, and is left in place.
+    """
+    init_db()
+    init_db_mda()
+    init_db_mda_text()
+    with db_lock:
+        config.metadata_db.execute("CREATE TABLE IF NOT EXISTS migrations (source text PRIMARY KEY, imported_at text)")
+        config.metadata_db.commit()
+        imported = {row[0] for row in config.metadata_db.execute("SELECT source FROM migrations")}
+        for db_path in sorted(glob.glob(os.path.join(config.download_path, 'metadata_*.db'))):
+            source = os.path.basename(db_path)
+            if source in imported or not re.fullmatch(r'metadata_\d{8}\.db', source):
+                continue
+            config.metadata_db.execute("ATTACH DATABASE ? AS daily", (db_path,))
+            try:
+                tables = [row[0] for row in config.metadata_db.execute("SELECT name FROM daily.sqlite_master "
+                                                                "WHERE type = 'table'")]
+                row_count = 0
+                for table in ['metadata', 'metadata_mda', 'metadata_mda_text']:
+                    if table in tables:
+                        """Named columns, since the daily files predate columns added since"""
+                        columns = ', '.join(row[1] for row in
+                                            config.metadata_db.execute(f"PRAGMA daily.table_info({table})"))
+                        cur = config.metadata_db.execute(f"INSERT INTO main.{table} ({columns}) "
+                                                         f"SELECT {columns} FROM daily.{table}")
+                        row_count += cur.rowcount
+                config.metadata_db.execute("INSERT INTO migrations VALUES (?, ?)",
+                                    (source, datetime.now().strftime('%Y%m%d %H:%M:%S')))
+                config.metadata_db.commit()
+            finally:
+                config.metadata_db.execute("DETACH DATABASE daily")
+            logger.info(f"Imported {row_count} rows from {source} into metadata.db")
+
+
+def metadata_commit():
+    with db_lock:
+        config.metadata_db.commit()
+
+
+def init_db_ledger():
+    cur = config.state_db.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS ledger 
+                (stage text, file_path text, file_size integer, mtime real, sha256 text, status text, output text, 
+                updated_at text, PRIMARY KEY (stage, file_path)
+                )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS ledger_sha256 ON ledger (stage, sha256)")
+    cur.close()
+
+
+def file_sha256(fpath, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def ledger_is_done(stage, fpath):
+    """
+    Checks the processing ledger for a file. A file is done if the stage recorded an outcome other than 'error' for
+    the same content. Only a stat() is needed for unchanged files; the content hash is computed only when size or mtime
+    differ from the ledger, so a touched but identical file is still recognised.
+    """
+    if stage in config.force_stages:
+        return False
+    with db_lock:
+        entry = config.state_db.execute("SELECT file_size, mtime, sha256, status FROM ledger "
+                                        "WHERE stage = ? AND file_path = ?", (stage, fpath)).fetchone()
+    if entry is None or entry[3] == 'error':
+        return False
+    file_size, mtime, sha256, status = entry
+    stat = os.stat(fpath)
+    if stat.st_size != file_size or (stat.st_mtime != mtime and file_sha256(fpath) != sha256):
+        return False
+    if stat.st_mtime != mtime:
+        with db_lock:
+            config.state_db.execute("UPDATE ledger SET mtime = ? WHERE stage = ? AND file_path = ?",
+                                    (stat.st_mtime, stage, fpath))
+    metrics.registry.inc('skipped_total', stage=stage)
+    return True
+
+
+def ledger_find_content(stage, fpath, sha256):
+    """
+    Finds another file with the same content that the stage already processed, such as the same filing saved under
+    both counters of a dual-counter stock.
+    :return: path of that file, or None if there is none or the stage is forced
+    """
+    if stage in config.force_stages:
+        return None
+    with db_lock:
+        entry = config.state_db.execute("SELECT file_path FROM ledger WHERE stage = ? AND sha256 = ? "
+                                        "AND file_path != ? AND status != 'error' ORDER BY updated_at LIMIT 1",
+                                        (stage, sha256, fpath)).fetchone()
+    return None if entry is None else entry[0]
+
+
+def find_duplicates(stage, fpaths):
+    """
+    Hashes files and pairs each one with an earlier file of the same content: one the stage already processed, or one
+    before it in fpaths.
+    :return: (sha256 per file, path of the earlier file per file or None)
+    """
+    hashes = [file_sha256(fpath) for fpath in fpaths]
+    first_seen = {}
+    originals = []
+    for fpath, sha256 in zip(fpaths, hashes):
+        original = first_seen.get(sha256) or ledger_find_content(stage, fpath, sha256)
+        first_seen.setdefault(sha256, original or fpath)
+        originals.append(original)
+    return hashes, originals
+
+
+def ledger_record(stage, fpath, status, output='', sha256=None):
+    """:param sha256: content hash of fpath if already computed"""
+    metrics.registry.inc('files_total', stage=stage, status=status)
+    stat = os.stat(fpath)
+    sha256 = sha256 or file_sha256(fpath)
+    with db_lock:
+        config.state_db.execute("INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (stage, fpath, stat.st_size, stat.st_mtime, sha256, status, output,
+                          datetime.now().strftime('%Y%m%d %H:%M:%S')))
+
+
+def store_blob(chunks, fpath, suffix=''):
+    """
+    Streams chunks into the blob store while hashing them, keeps one blob per content, and hardlinks fpath to it.
+    :param chunks: iterable of bytes, such as a streamed response's iter_content()
+    :param suffix: file extension of the blob, e.g. '.pdf'
+    :return: SHA-256 of the content
+    """
+    os.makedirs(config.blobs_path, exist_ok=True)
+    fd, tmp_fpath = tempfile.mkstemp(dir=config.blobs_path, suffix='.part')
+    sha256 = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                sha256.update(chunk)
+                f.write(chunk)
+        blob_fpath = os.path.join(config.blobs_path, sha256.hexdigest()[:2], sha256.hexdigest() + suffix)
+        os.makedirs(os.path.dirname(blob_fpath), exist_ok=True)
+        if os.path.exists(blob_fpath):
+            os.remove(tmp_fpath)
+        else:
+            os.replace(tmp_fpath, blob_fpath)
+    except BaseException:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+    link_file(blob_fpath, fpath)
+    return sha256.hexdigest()
+
+
+def link_file(source_fpath, dest_fpath):
+    """Hardlinks dest_fpath to source_fpath, or copies it where hardlinks are not supported"""
+    try:
+        os.link(source_fpath, dest_fpath)
+    except OSError:
+        shutil.copyfile(source_fpath, dest_fpath)
+
+
+def init_db_watermarks():
+    config.state_db.execute("""CREATE TABLE IF NOT EXISTS watermarks 
+                            (report_type text, stock_id text, date_time text, news_id integer, updated_at text, 
+                            PRIMARY KEY (report_type, stock_id)
+                            )""")
+
+
+def load_watermark(report_type, stock_id):
+    """:return: (date_time as yyyymmddHHMM, news_id) of the newest filing processed in tail mode, or None"""
+    with db_lock:
+        entry = config.state_db.execute("SELECT date_time, news_id FROM watermarks WHERE report_type = ? "
+                                        "AND stock_id = ?", (str(report_type), str(stock_id))).fetchone()
+    return None if entry is None else tuple(entry)
+
+
+def save_watermark(report_type, stock_id, watermark):
+    with db_lock:
+        config.state_db.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?, ?)",
+                                (str(report_type), str(stock_id), watermark[0], watermark[1],
+                                 datetime.now().strftime('%Y%m%d %H:%M:%S')))
+        config.state_db.commit()
+
+
+def ledger_commit():
+    with db_lock:
+        config.state_db.commit()
+
+
 def get_filenames(input_folder):
     sublist = os.listdir(input_folder)
     sublist.sort()
@@ -248,6 +713,9 @@ def mda_exists(outlines_list):
 
 
 def group_outlines(parentFolder='hkex_reports', interval='yearly'):
+    import pandas as pd
+    import PyPDF2
+    import pikepdf
     folderList = os.listdir(parentFolder)
     folderList.sort()
     base_year = 0000
@@ -359,6 +827,7 @@ def count_outlines(outline_list, year):
 
 
 def count_doc_types(fromDate, toDate, parentFolder='hkex_reports', interval='monthly'):
+    import pandas as pd
     folderList = os.listdir(parentFolder)
     folderList.sort()
     base_year = 0000